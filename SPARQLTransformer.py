@@ -1,11 +1,19 @@
 import logging
-import pprint
 import os
 import re
 import json
 import copy
-from SPARQLWrapper import SPARQLWrapper, JSON
-from simplejson import dumps
+import operator
+import codecs
+import itertools
+import io
+import time
+import threading
+import weakref
+from collections import Counter, OrderedDict, namedtuple
+
+# the modules needed only by some functions (HTTP client, cache database, asyncio, debug output...) are imported
+# where they are used, to keep the import of this module fast
 
 INDENT = '          '
 
@@ -31,8 +39,37 @@ KEY_VOCABULARIES = {
 LANG_REGEX = re.compile(r"^lang(?::(.+))?")
 AGGREGATES = ['sample', 'count', 'sum', 'min', 'max', 'avg']
 
-logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.WARNING)
 logger = logging.getLogger('sparql_transformer')
+logger.addHandler(logging.NullHandler())  # the logging configuration is left to the application
+
+
+class _DebugHandler(logging.StreamHandler):
+    """Print the output of the `debug` option in the console, unless the application configured logging"""
+
+    def emit(self, record):
+        if not logging.root.handlers:
+            super().emit(record)
+
+
+# logger of the calls with the `debug` option: the level of `logger` is never changed, as it is shared by all threads
+debug_logger = logging.getLogger('sparql_transformer.debug')
+debug_logger.setLevel(logging.DEBUG)
+debug_logger.addHandler(_DebugHandler())
+debug_logger.handlers[-1].setFormatter(logging.Formatter('%(levelname)s:%(message)s'))
+
+
+def _logger(opt):
+    """The logger of a transformation with the given options"""
+    return debug_logger if opt.get('debug') else logger
+
+
+PRE_PROCESS_CACHE_SIZE = 256
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+_pre_process_cache = OrderedDict()
+_pre_process_cache_stats = {'hits': 0, 'misses': 0}
+_pre_process_cache_lock = threading.Lock()
 
 
 def pre_process(json_query, options=None):
@@ -40,7 +77,74 @@ def pre_process(json_query, options=None):
 
     If the query is a JSON-LD query, the target prototype is contained in the `@graph` element. For non-JSON-LD queries, the JSON structure should 
     include a `proto` element with the transformation prototype.
+
+    With the `cache` option, the result is kept in a LRU cache of `PRE_PROCESS_CACHE_SIZE` entries, shared by all the
+    calls with equal query and options.
     '''
+    if options is not None and options.get('cache') and isinstance(json_query, dict):
+        processed = _cached_pre_process(json_query, options)
+    else:
+        processed = _pre_process(json_query, options)
+
+    if processed is not None:
+        query, proto, opt = processed
+        log = _logger(opt)
+        if log.isEnabledFor(logging.DEBUG):
+            import pprint
+            log.debug('OPTIONS:\n%s', pprint.pformat(opt))
+        log.info(query)
+    return processed
+
+
+def pre_process_cache_info():
+    """Return hits, misses, maximum and current size of the `pre_process` cache"""
+    with _pre_process_cache_lock:
+        return CacheInfo(_pre_process_cache_stats['hits'], _pre_process_cache_stats['misses'],
+                         PRE_PROCESS_CACHE_SIZE, len(_pre_process_cache))
+
+
+def pre_process_cache_clear():
+    """Empty the `pre_process` cache and reset its statistics"""
+    with _pre_process_cache_lock:
+        _pre_process_cache.clear()
+        _pre_process_cache_stats['hits'] = 0
+        _pre_process_cache_stats['misses'] = 0
+
+
+def _is_data(value):
+    return value is None or isinstance(value, (str, int, float, bool, list, tuple, dict))
+
+
+def _cached_pre_process(json_query, options):
+    # options like `sparqlFunction` are not part of the key: they are given back as they are at every call
+    runtime = {k: v for k, v in options.items() if not _is_data(v)}
+    key = json.dumps([json_query, {k: v for k, v in options.items() if k not in runtime}], sort_keys=True)
+
+    with _pre_process_cache_lock:
+        entry = _pre_process_cache.get(key)
+        if entry is not None:
+            _pre_process_cache.move_to_end(key)
+            _pre_process_cache_stats['hits'] += 1
+        else:
+            _pre_process_cache_stats['misses'] += 1
+
+    if entry is None:
+        query, proto, opt = _pre_process(json_query, options)
+        entry = (query, copy.deepcopy(proto), {k: copy.deepcopy(v) for k, v in opt.items() if k not in runtime})
+        with _pre_process_cache_lock:
+            _pre_process_cache[key] = entry
+            while len(_pre_process_cache) > PRE_PROCESS_CACHE_SIZE:
+                _pre_process_cache.popitem(last=False)
+        return query, proto, opt
+
+    # the cached entry is never returned, the caller is free to modify its own copy
+    query, proto, opt = entry
+    opt = copy.deepcopy(opt)
+    opt.update(runtime)
+    return query, copy.deepcopy(proto), opt
+
+
+def _pre_process(json_query, options=None):
     _input = json_query.copy()
     opt = DEFAULT_OPTIONS.copy()
     if '@context' in _input:
@@ -48,15 +152,6 @@ def pre_process(json_query, options=None):
     if options is not None:
         opt.update(options)
 
-    if 'debug' in opt and opt['debug']:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.NOTSET)
-
-    logger.debug('OPTIONS:')
-    if logger.getEffectiveLevel() == logging.DEBUG:
-        pprint.pprint(opt)
-
     if isinstance(_input, str):
         if os.path.isfile(_input):
             with open(_input) as data:
@@ -72,7 +167,13 @@ def pre_process(json_query, options=None):
     if '$langTag' in _input:
         opt['langTag'] = _input['$langTag']
 
-    proto, query = _jsonld2query(_input)
+    chunks = _split_values(_input, opt['valuesChunkSize']) if opt.get('valuesChunkSize') else None
+
+    if opt.get('splitQuery') and 'graph' not in opt:  # the queries on a local graph are not split
+        proto, query, split = _jsonld2query(_input, opt['splitQuery'])
+    else:
+        proto, query = _jsonld2query(_input)
+        split = None
 
     is_json_ld = '@graph' in _input
     voc = KEY_VOCABULARIES['JSONLD' if is_json_ld else 'PROTO']
@@ -80,41 +181,157 @@ def pre_process(json_query, options=None):
     opt['is_json_ld'] = is_json_ld
 
     if '$limitMode' in json_query and '$limit' in json_query:
-        opt['limit'] = json_query['$limit']
-        opt['offset'] = json_query.get('$offset', 0)
+        anchor_var = _root_anchor_variable(proto)
+        if opt.get('paging') and anchor_var and _is_pageable(json_query, query):
+            query = _paged_query(query, anchor_var, json_query['$limit'], json_query.get('$offset', 0))
+            split = None
+        else:
+            opt['limit'] = json_query['$limit']
+            opt['offset'] = json_query.get('$offset', 0)
+
+    # the queries whose results are concatenated in place of the results of the query
+    if split:
+        queries, opt['split_keys'] = split
+    else:
+        queries = [query]
+    if chunks:
+        if _is_chunkable(json_query, query, opt):
+            queries = [q.replace(VALUES_CHUNK, chunk) for q in queries for chunk in chunks]
+        else:
+            queries = [q.replace(VALUES_CHUNK, ' '.join(chunks)) for q in queries]
+        query = query.replace(VALUES_CHUNK, ' '.join(chunks))
+    if len(queries) > 1:
+        opt['queries'] = queries
 
     return query, proto, opt
 
 
-def post_process(sparql_res, proto, opt):
-    is_json_ld = opt['is_json_ld']
+VALUES_CHUNK = '$values:chunk'  # placeholder of the values of the split `$values` variable, kept as is in the query
 
-    bindings = sparql_res['results']['bindings']
-    # apply the proto
-    instances = list(map(lambda b: _sparql2proto(b, proto, opt), bindings))
-    # merge lines with the same id
-    content = []
-    anchor = instances[0]['$anchor'] if (len(instances) > 0 and '$anchor' in instances[0]) else None
-    if not anchor:
-        content = instances
-    else:
-        for inst in instances:
-            _id = inst[anchor]
-            # search if we have already the same id
-            match = [x for x in content if x[anchor] == _id]
-            if not match:  # it is a new one
-                content.append(inst)
-            else:  # otherwise modify previous one
-                _merge_obj(match[0], inst)
 
-    # remove anchor tag
-    for i in content:
-        clean_recursively(i)
+def _split_values(json_query, chunk_size):
+    """Split the longest list of `$values` of `json_query` in chunks of `chunk_size` values.
+
+    The values are replaced by `VALUES_CHUNK` and the SPARQL terms of each chunk are returned, or None if no list is
+    longer than `chunk_size`."""
+    values = json_query.get('$values')
+    if not values:
+        return None
+    variable = max(values, key=lambda v: len(_as_array(values[v])))
+    terms = _as_array(values[variable])
+    if len(terms) <= chunk_size:
+        return None
+    values[variable] = [VALUES_CHUNK]  # a list, like the values it replaces
+    terms = list(map(_values_term, terms))
+    return [_normalize_query(' '.join(terms[i:i + chunk_size])) for i in range(0, len(terms), chunk_size)]
+
+
+def _is_chunkable(json_query, query, opt):
+    """Check if the results of the query can be obtained concatenating the results of its chunks"""
+    if any(k in json_query for k in ['$orderby', '$groupby', '$having']) or AGGREGATE_REGEX.search(query):
+        return False
+    # the limit can only be applied to all the results, and not in a subquery
+    return not ('$limit' in json_query or '$offset' in json_query) or \
+        (json_query.get('$limitMode') == 'library' and 'limit' in opt)
+
+
+VALUES_CONCURRENCY = 8  # default of the `valuesConcurrency` option
+
+
+def _run_query(sparql_fun, query, opt, stats=None):
+    """Execute the query with `sparql_fun`, or concurrently the queries in which it has been split
+    (by `valuesChunkSize` or `splitQuery`).
+
+    If `stats` is given, the time elapsed is added to its `network` stage, excluding the time spent decoding the
+    results (added to `decode` by `sparql_fun`). The decoding of concurrent queries holds the GIL, so their decoding
+    times do not overlap.
+    The queries on a local graph are not split: they are not limited in size and rdflib cannot parse them in
+    concurrent threads."""
+    if stats is not None:
+        start, decode = time.perf_counter(), stats['decode']
+    queries = opt.get('queries')
+    try:
+        if not queries or 'graph' in opt:
+            return sparql_fun(query)
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(min(opt.get('valuesConcurrency', VALUES_CONCURRENCY), len(queries))) as executor:
+            return _concat_results(list(executor.map(sparql_fun, queries)))
+    finally:
+        if stats is not None:
+            stats['network'] += max(0.0, time.perf_counter() - start - (stats['decode'] - decode))
+
+
+def _concat_results(results):
+    """Concatenate the SPARQL results (in JSON, TSV or rdflib results) of the queries in which a query has been
+    split"""
+    if _is_rdflib_result(results[0]):
+        from rdflib.query import Result
+
+        res = Result('SELECT')
+        res.vars = list(dict.fromkeys(v for r in results for v in r.vars))
+        res.bindings = [b for r in results for b in r.bindings]
+        return res
+    if isinstance(results[0], (str, bytes)) and len({_tsv_header(r) for r in results}) > 1:
+        # the queries of `splitQuery` select different variables
+        return _concat_results([_parse_tsv(r) for r in results])
+    if isinstance(results[0], (str, bytes)):
+        lines = []
+        for i, text in enumerate(results):
+            text = text.decode('utf-8') if isinstance(text, bytes) else text
+            if i:
+                text = text[text.find('\n') + 1:] if '\n' in text else ''
+            if text and not text.endswith('\n'):
+                text += '\n'
+            lines.append(text)
+        return ''.join(lines)
+    return {'head': {'vars': list(dict.fromkeys(v for res in results for v in res.get('head', {}).get('vars', [])))},
+            'results': {'bindings': [b for res in results for b in res['results']['bindings']]}}
+
+
+def _tsv_header(text):
+    text = text.decode('utf-8') if isinstance(text, bytes) else text
+    return text.split('\n', 1)[0].rstrip('\r')
+
+
+AGGREGATE_REGEX = re.compile(r'\((?:%s)\(' % '|'.join(AGGREGATES), re.IGNORECASE)
+
+
+def _is_pageable(json_query, query):
+    """Check if the library limit of the query can be applied to the anchors in a subquery"""
+    if any(k in json_query for k in ['$orderby', '$groupby', '$having']):
+        return False
+    return not AGGREGATE_REGEX.search(query)
+
+
+def _paged_query(query, anchor_var, limit, offset):
+    """Restrict the query to `limit` root anchors, starting from `offset`.
+
+    The anchors are selected in a subquery having the same WHERE clause, ordered by anchor."""
+    start = query.index('WHERE {') + len('WHERE {')
+    end = query.rindex('}')
+    body = query[start:end]
+    subquery = '{ SELECT DISTINCT ?%s WHERE {%s} ORDER BY ?%s LIMIT %d OFFSET %d }' % (
+        anchor_var, body, anchor_var, limit, offset)
+    return '%s\n%s%s%s}\n        ORDER BY ?%s\n' % (query[:start], INDENT, subquery, body, anchor_var)
+
+
+def post_process(sparql_res, proto, opt, stats=None):
+    """Transform the SPARQL results according to the prototype.
+
+    If a `stats` dict (see `new_stats`) is given, the time of each stage and the counters are added to it.
+    With the `processes` option, large results are transformed in parallel (see `_parallel_transform`)."""
+    content = _parallel_transform(sparql_res, proto, opt, stats) if opt.get('processes') else None
+    if content is None:
+        content = _transform(sparql_res, proto, opt, stats)
 
     if 'limit' in opt:
         content = content[opt['offset']: opt['offset'] + opt['limit']]
+    if stats is not None:
+        stats['entities'] += len(content)
 
-    if is_json_ld:
+    if opt['is_json_ld']:
         return {
             '@context': opt['context'],
             '@graph': content
@@ -122,18 +339,710 @@ def post_process(sparql_res, proto, opt):
     return content
 
 
+def _transform(sparql_res, proto, opt, stats=None):
+    """Apply the prototype to the SPARQL results and merge the instances, returning the root entities"""
+    start = time.perf_counter() if stats is not None else None
+
+    tsv = isinstance(sparql_res, (str, bytes))  # results in TSV
+    # apply the proto
+    if _is_rdflib_result(sparql_res):
+        build = _compile_proto(proto, opt, terms=True)
+        instances = [build(line) for line in _rdflib_rows(sparql_res)]
+    elif opt.get('columnar') and not _has_list(proto):
+        if tsv:
+            columns, length = _tsv_columns(sparql_res)
+        else:
+            bindings = sparql_res['results']['bindings']
+            columns, length = _to_columns(bindings), len(bindings)
+        if stats is not None:
+            start = _lap(stats, 'decode', start)
+        build = _compile_proto(proto, opt, columns)
+        instances = [build(i) for i in range(length)]
+    else:
+        if tsv:
+            sparql_res = _parse_tsv(sparql_res)
+            if stats is not None:
+                start = _lap(stats, 'decode', start)
+        build = _compile_proto(proto, opt)
+        instances = [build(b) for b in sparql_res['results']['bindings']]
+    if stats is not None:
+        start = _lap(stats, 'proto', start)
+        stats['bindings'] += len(instances)
+        stats['instances'] += len(instances)
+    # merge lines with the same id
+    anchor = instances[0]['$anchor'] if (len(instances) > 0 and '$anchor' in instances[0]) else None
+    # the results of the queries of `splitQuery` (see `_run_query`)
+    split = 'split_keys' in opt and 'queries' in opt and anchor is not None
+    stubs = _remove_stubs(instances, proto, anchor, opt) if split else None
+    content = _merge_instances(instances, anchor, stats) if anchor else instances
+    if split:  # the properties of the different queries are put back in the order of the prototype
+        content = [_restore_stubs(entity, proto, stubs.get(_anchor_key(entity[anchor]), {})) for entity in content]
+    if stats is not None:
+        start = _lap(stats, 'merge', start)
+
+    # remove anchor tag
+    clean = _compile_clean(proto)
+    for i in content:
+        clean(i)
+    if stats is not None:
+        _lap(stats, 'clean', start)
+    return content
+
+
+def _remove_stubs(instances, proto, anchor, opt):
+    """Remove from the instances the nested objects without values of their own, and return them by anchor and
+    property.
+
+    The queries of `splitQuery` select the root anchor and the variables of their properties only: in the lines of
+    each query, the nested objects of the others (split or not) are built without values, only with their constant
+    properties and the value of the root anchor. They are added back after merging, to the entity they were built
+    for, if it does not have the property, as in the single query."""
+    stubs = {}
+    anchor_variable = _root_anchor_variable(proto)
+    nested = [k for k, v in proto.items() if isinstance(v, dict)]
+    for instance in instances:
+        for k in nested:
+            if k in instance and _is_stub(instance[k], proto[k], anchor_variable, opt):
+                stubs.setdefault(_anchor_key(instance[anchor]), {})[k] = instance.pop(k)
+    return stubs
+
+
+def _is_stub(value, proto, anchor_variable, opt):
+    if type(value) is list and len(value) == 1:
+        value = value[0]
+    if type(value) is not dict:
+        return False
+    for k, v in value.items():
+        p = proto.get(k)
+        if isinstance(p, dict):
+            if not _is_stub(v, p, anchor_variable, opt):
+                return False
+        elif isinstance(p, list) or isinstance(p, str) and p.startswith('?') and \
+                _parse_proto_variable(p, opt)[0] != anchor_variable:
+            return False
+    return True
+
+
+def _restore_stubs(entity, proto, stubs):
+    return {k: entity[k] if k in entity else copy.deepcopy(stubs[k]) for k in proto if k in entity or k in stubs}
+
+
+PARALLEL_THRESHOLD = 100000  # default of the `parallelThreshold` option
+
+
+def _parallel_transform(sparql_res, proto, opt, stats=None):
+    """`_transform` in `opt['processes']` worker processes (all the CPUs if `True`).
+
+    The lines are split in shards by the value of the root anchor, assigning the anchors to the shards in turn,
+    so that all the lines of an entity are in the same shard. The entities of the shards are put back in the order
+    of their first appearance in the results, as in a serial run.
+    Return None if the results have less lines than the `parallelThreshold` option or cannot be split by anchor
+    (no root anchor, lines without it, or less than two anchors): they are then transformed in this process."""
+    processes = opt['processes']
+    if _is_rdflib_result(sparql_res):
+        return None
+    if processes is True:
+        processes = os.cpu_count() or 1
+    anchor = proto.get('$anchor')
+    variable = _root_anchor_variable(proto)
+    if processes < 2 or variable is None:
+        return None
+    threshold = opt.get('parallelThreshold', PARALLEL_THRESHOLD)
+    start = time.perf_counter() if stats is not None else None
+
+    if isinstance(sparql_res, (str, bytes)):  # TSV: the shards are sent as text, faster to pickle
+        text = sparql_res.decode('utf-8') if isinstance(sparql_res, bytes) else sparql_res
+        lines = text.split('\n')
+        if lines[-1] == '':
+            lines.pop()
+        header, rows = lines[0] if lines else '', lines[1:]
+        variables = _tsv_variables(header)
+        if len(rows) < threshold or variable not in variables:
+            return None
+        column = variables.index(variable)
+        terms = {}
+
+        def cell_of(row):
+            term = row.rstrip('\r').split('\t', column + 1)[column] if row.count('\t') >= column else ''
+            if not term:
+                return None
+            cell = terms.get(term)
+            if cell is None:
+                cell = terms[term] = _parse_tsv_term(term)
+            return cell
+
+        def shard_results(shard):
+            return '\n'.join([header] + shard)
+    else:
+        rows = sparql_res['results']['bindings']
+        if len(rows) < threshold:
+            return None
+
+        def cell_of(row):
+            return row.get(variable)
+
+        def shard_results(shard):
+            return {'results': {'bindings': shard}}
+
+    _, anchor_opt = _parse_proto_variable(proto[anchor], opt)
+    values = {}  # converted anchor values
+    ranks = {}  # anchor key -> rank of first appearance
+    shards = [[] for _ in range(processes)]
+    shard_ranks = [[] for _ in range(processes)]  # ranks of the entities of each shard, in order
+    for row in rows:
+        cell = cell_of(row)
+        if cell is None:
+            return None
+        term = (cell['value'], cell.get('datatype'), cell.get('xml:lang'))
+        key = values.get(term)
+        if key is None:
+            value = _to_jsonld_value(cell, anchor_opt)
+            if value is None:
+                return None
+            key = values[term] = _anchor_key(value)
+        rank = ranks.get(key)
+        if rank is None:
+            rank = ranks[key] = len(ranks)
+            shard_ranks[rank % processes].append(rank)
+        shards[rank % processes].append(row)
+
+    import gc
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    shard_opt = {k: v for k, v in opt.items() if _is_data(v)}  # callables and objects are not sent to the workers
+    shard_opt['processes'] = None
+    shards = [(shard_results(shard), entity_ranks) for shard, entity_ranks in zip(shards, shard_ranks) if shard]
+    if len(shards) < 2:
+        return None
+    content = [None] * len(ranks)
+    # the start method set by the application, or the default one, without setting it for the whole process
+    context = multiprocessing.get_context(multiprocessing.get_start_method(allow_none=True) or
+                                          multiprocessing.get_all_start_methods()[0])
+    # forked workers find the shards in their copy of `_SHARDS` instead of receiving them pickled, and the objects
+    # inherited from this process are frozen, so that their garbage collection does not copy them
+    forked = context.get_start_method() == 'fork'
+    token = object()
+    try:
+        with ProcessPoolExecutor(len(shards), mp_context=context) as executor:
+            if forked:
+                _SHARDS[id(token)] = shards
+                gc.freeze()
+            try:
+                futures = [(executor.submit(_transform_shard, (id(token), i) if forked else shard, proto, shard_opt,
+                                            forked, stats is not None), entity_ranks)
+                           for i, (shard, entity_ranks) in enumerate(shards)]
+            finally:
+                if forked:
+                    gc.unfreeze()
+            for future, entity_ranks in futures:
+                entities, counters = future.result()
+                for rank, entity in zip(entity_ranks, entities):
+                    content[rank] = entity
+                if stats is not None:
+                    for k in STATS_COUNTERS:
+                        stats[k] += counters[k]
+    finally:
+        _SHARDS.pop(id(token), None)
+
+    if stats is not None:
+        _lap(stats, 'proto', start)  # the application of the proto and the merge, in the workers
+    return content
+
+
+_SHARDS = {}  # shards of the results being transformed in parallel
+
+
+def _transform_shard(shard, proto, opt, forked=False, counted=False):
+    """Transform a shard in a worker process, returning the entities and (if `counted`) the counters of the
+    statistics. If `forked`, `shard` is the key of the shard in `_SHARDS`."""
+    if forked:
+        token, i = shard
+        shard = _SHARDS[token][i][0]
+    stats = new_stats() if counted else None
+    content = _transform(shard, proto, opt, stats)
+    return content, stats and {k: stats[k] for k in STATS_COUNTERS}
+
+
 def sparqlTransformer(_input, options=None):
+    stats = new_stats() if options and options.get('onStats') else None
+    start = time.perf_counter() if stats is not None else None
     query, proto, opt = pre_process(_input, options)
-    sparql_fun = opt['sparqlFunction'] if 'sparqlFunction' in opt else _default_sparql(opt['endpoint'])
-    sparql_res = sparql_fun(query)
+    if stats is not None:
+        _lap(stats, 'query', start)
+    sparql_fun = _sparql_function(opt, stats)
+    sparql_res = _run_query(sparql_fun, query, opt, stats)
 
-    logger.debug(sparql_res)
+    _logger(opt).debug(sparql_res)
 
-    return post_process(sparql_res, proto, opt)
+    out = post_process(sparql_res, proto, opt, stats)
+    if stats is not None:
+        opt['onStats'](stats)
+    return out
+
+
+STATS_STAGES = ['query', 'network', 'decode', 'proto', 'merge', 'clean']
+STATS_COUNTERS = ['bindings', 'instances', 'merges', 'comparisons', 'entities']
+
+
+def new_stats():
+    """Return a dict for the statistics of a transformation: the time in seconds of each stage (`STATS_STAGES`)
+    and the counters (`STATS_COUNTERS`), all set to 0"""
+    stats = dict.fromkeys(STATS_STAGES, 0.0)
+    stats.update(dict.fromkeys(STATS_COUNTERS, 0))
+    return stats
+
+
+_stats_lock = threading.Lock()  # the results of concurrent queries are decoded in different threads
+
+
+def _lap(stats, stage, start):
+    """Add the time elapsed since `start` to the stage, and return the current time"""
+    now = time.perf_counter()
+    stats[stage] += now - start
+    return now
+
+
+def prepare(json_query, options=None):
+    """Compile a JSON query having `{{name}}` parameters into a `PreparedQuery`, to execute it many times with
+    different values of the parameters.
+
+    A parameter can be the value of a `$values` variable (e.g. `"$values": {"id": "{{id}}"}`) or appear in any
+    other part of the query, like `$filter` (e.g. `"?date > {{since}}"`).
+    With `splitQuery`, the split queries are prepared too. With `valuesChunkSize`, the lists of values of the
+    `$values` parameters longer than it are split in chunks at every execution."""
+    query, proto, opt = pre_process(json_query, options)
+    chunkable = bool(opt.get('valuesChunkSize')) and _is_chunkable(json_query, query, opt)
+    return PreparedQuery(query, proto, opt, chunkable)
+
+
+PARAMETER_REGEX = re.compile(r'"\{\{(\w+)\}\}"|\{\{(\w+)\}\}')  # quoted by `parse_values` or not
+
+
+class PreparedQuery:
+    """A query compiled once by `prepare`, whose parameters are bound at every execution.
+
+    Binding a parameter only escapes its value and puts it in the SPARQL query: neither the query nor the
+    prototype are generated again."""
+
+    def __init__(self, query, proto, opt, chunkable=False):
+        self.proto = proto
+        self.opt = opt
+        self._query = self._template(query)
+        # the queries of `splitQuery` (or of the chunks of a list of values not given as parameter)
+        self._queries = [self._template(q) for q in opt.get('queries', [])]
+        self.parameters = {name for name, _ in self._query[1]}
+        # the parameters that can be split in chunks are only used as values of a `$values` variable
+        self._chunkable = {name for name, separator in self._query[1] if separator == ' '} - \
+            {name for name, separator in self._query[1] if separator != ' '} if chunkable else set()
+
+    @staticmethod
+    def _template(query):
+        # the text of the query alternates with the parameters, as (name, separator of the values of a list):
+        # the values of the `$values` variables are separated by spaces, the others by commas
+        split = PARAMETER_REGEX.split(query)
+        return split[::3], [(quoted, ' ') if quoted else (name, ', ') for quoted, name in zip(split[1::3], split[2::3])]
+
+    def bind(self, parameters):
+        """The SPARQL query with the given values of the parameters.
+
+        A value can be a list of values (e.g. for a `$values` variable or in `IN (...)`). The strings starting
+        with `http` are IRIs, the prefixed names (like `dbr:Italy`) are kept as they are, the strings ending with
+        a language tag (like `Italy@en`) are language-tagged literals and the others plain literals."""
+        missing = self.parameters - set(parameters)
+        if missing:
+            raise KeyError('Missing parameters: %s' % ', '.join(sorted(missing)))
+        return self._bind(self._query, parameters)
+
+    @staticmethod
+    def _bind(template, parameters):
+        texts, names = template
+        parts = [texts[0]]
+        for (name, separator), text in zip(names, texts[1:]):
+            parts.append(_sparql_terms(parameters[name], separator))
+            parts.append(text)
+        return ''.join(parts)
+
+    def _bind_queries(self, parameters):
+        """The queries executed in place of the query (see `_run_query`), with the given values of the parameters"""
+        chunk_size = self.opt.get('valuesChunkSize')
+        lists = [name for name in self._chunkable if len(_as_array(parameters[name])) > chunk_size]
+        if lists:
+            name = max(lists, key=lambda n: len(_as_array(parameters[n])))
+            values = _as_array(parameters[name])
+            chunks = [dict(parameters, **{name: values[i:i + chunk_size]}) for i in range(0, len(values), chunk_size)]
+        else:
+            chunks = [parameters]
+        return [self._bind(template, chunk) for template in self._queries or [self._query] for chunk in chunks]
+
+    def __call__(self, parameters=None, options=None):
+        """Execute the query with the given values of the parameters, as `sparqlTransformer`.
+
+        `options` can replace the runtime options given to `prepare`, like `sparqlFunction` or `onStats`."""
+        opt = self.opt if not options else dict(self.opt, **options)
+        stats = new_stats() if opt.get('onStats') else None
+        start = time.perf_counter() if stats is not None else None
+        query = self.bind(parameters or {})
+        queries = self._bind_queries(parameters or {})
+        opt = dict(opt, queries=queries) if len(queries) > 1 else {k: v for k, v in opt.items() if k != 'queries'}
+        if stats is not None:
+            _lap(stats, 'query', start)
+        log = _logger(opt)
+        log.info(query)
+        sparql_res = _run_query(_sparql_function(opt, stats), query, opt, stats)
+
+        log.debug(sparql_res)
+
+        out = post_process(sparql_res, self.proto, opt, stats)
+        if stats is not None:
+            opt['onStats'](stats)
+        return out
+
+
+BATCH_CONCURRENCY = 8
+
+
+def sparqlTransformer_batch(queries, concurrency=BATCH_CONCURRENCY):
+    """Run `sparqlTransformer` on a list of `(query, options)` pairs (or of queries alone), with at most
+    `concurrency` SPARQL queries running at the same time.
+
+    The results are returned in the same order of `queries`. A failing transformation does not stop the others:
+    the exception raised is returned in place of its result."""
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    results = [None] * len(queries)
+    pending = {}
+    for i, item in enumerate(queries):
+        _input, options = item if isinstance(item, tuple) else (item, None)
+        stats = new_stats() if options and options.get('onStats') else None
+        try:
+            start = time.perf_counter() if stats is not None else None
+            query, proto, opt = pre_process(_input, options)
+            if stats is not None:
+                _lap(stats, 'query', start)
+            pending[i] = (_sparql_function(opt, stats), query, proto, opt, stats)
+        except Exception as e:
+            results[i] = e
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_run_query, sparql_fun, query, opt, stats): i
+                   for i, (sparql_fun, query, _, opt, stats) in pending.items()}
+        for future in as_completed(futures):
+            i = futures[future]
+            _, _, proto, opt, stats = pending[i]
+            try:
+                results[i] = post_process(future.result(), proto, opt, stats)
+                if stats is not None:
+                    opt['onStats'](stats)
+            except Exception as e:
+                results[i] = e
+    return results
+
+
+async def sparqlTransformer_async(_input, options=None):
+    """Asynchronous version of `sparqlTransformer`.
+
+    `sparqlFunction` can be a coroutine function. Without it, the query is sent to the endpoint with aiohttp (reusing
+    the `session` option if given) or, if aiohttp is not installed, with the default client in a thread.
+    With the `executor` option (`True` for the default executor, or a `concurrent.futures.Executor`), `post_process`
+    runs in the executor, so that large results do not block the event loop."""
+    import asyncio
+    import inspect
+
+    stats = new_stats() if options and options.get('onStats') else None
+    start = time.perf_counter() if stats is not None else None
+    query, proto, opt = pre_process(_input, options)
+    if stats is not None:
+        start = _lap(stats, 'query', start)
+    cache = opt.get('resultCache') if 'graph' not in opt else None
+    sparql_fun = None
+    semaphore = asyncio.Semaphore(opt.get('valuesConcurrency', VALUES_CONCURRENCY))
+
+    async def execute(q):
+        nonlocal sparql_fun
+        if sparql_fun is None:
+            sparql_fun = opt['sparqlFunction'] if 'sparqlFunction' in opt else \
+                _graph_sparql(opt['graph']) if 'graph' in opt else _default_sparql_async(opt)
+        async with semaphore:
+            res = sparql_fun(q)
+            if inspect.isawaitable(res):
+                res = await res
+        return res
+
+    async def execute_and_read(q):
+        return _read_results(await execute(q), opt)
+
+    async def fetch(q):
+        if cache is None:
+            return await execute(q)
+        return await cache.fetch_async(opt['endpoint'], q, execute_and_read)
+
+    if opt.get('queries'):
+        sparql_res = _concat_results(await asyncio.gather(*map(fetch, opt['queries'])))
+    else:
+        sparql_res = await fetch(query)
+    if stats is not None:
+        _lap(stats, 'network', start)
+
+    _logger(opt).debug(sparql_res)
+
+    executor = opt.get('executor')
+    if executor:
+        loop = asyncio.get_running_loop()
+        out = await loop.run_in_executor(None if executor is True else executor, post_process, sparql_res, proto, opt,
+                                         stats)
+    else:
+        out = post_process(sparql_res, proto, opt, stats)
+    if stats is not None:
+        opt['onStats'](stats)
+    return out
+
+
+def iter_post_process(bindings, proto, opt, ordered=False, terms=False):
+    """Apply the prototype to an iterable of bindings, yielding the root entities (the elements of `@graph`
+    for JSON-LD queries) one by one.
+
+    If `terms` is true, the bindings are lines of rdflib terms (see `_rdflib_rows`).
+
+    If `ordered` is true, the bindings are expected to be grouped by anchor (e.g. ordered by the anchor
+    variable): each entity is yielded as soon as the anchor changes, and only one entity is kept in memory.
+    Otherwise, all the bindings are merged before the first entity is yielded."""
+    build = _compile_proto(proto, opt, terms=terms)
+    anchor = proto.get('$anchor')
+    start = opt.get('offset', 0) if 'limit' in opt else 0
+    stop = start + opt['limit'] if 'limit' in opt else None
+
+    if anchor and not ordered:
+        entities = _merge_instances((build(b) for b in bindings), anchor)
+    elif anchor:
+        entities = _iter_grouped_instances((build(b) for b in bindings), anchor)
+    else:
+        entities = (build(b) for b in bindings)
+
+    for i, entity in enumerate(entities):
+        if stop is not None and i >= stop:
+            return
+        if i >= start:
+            clean_recursively(entity)
+            yield entity
 
 
-def _jsonld2query(_input):
-    """Read the input and extract the query and the prototype"""
+def iter_sparqlTransformer(_input, options=None):
+    """Generator version of `sparqlTransformer`, yielding the root entities while the results are downloaded.
+
+    The bindings are parsed incrementally from the response of the endpoint (or from the file-like object
+    returned by `sparqlFunction`). When the query is ordered by the anchor variable (or the `ordered` option is
+    set), each entity is yielded as soon as all its bindings have been read."""
+    query, proto, opt = pre_process(_input, options)
+    yield from _iter_entities(_input, query, proto, opt)
+
+
+def _iter_entities(_input, query, proto, opt):
+    tsv = opt.get('format') == 'tsv'
+    if 'sparqlFunction' in opt or 'resultCache' in opt or 'graph' in opt:
+        sparql_res = _sparql_function(opt)(query)
+    else:
+        client = _endpoint_client(opt['endpoint'], **_endpoint_options(opt))
+        sparql_res = client.stream(query, ACCEPT_TSV if tsv else ACCEPT_JSON)
+
+    ordered = opt.get('ordered', False) or _is_ordered_by_anchor(_input, proto)
+    if _is_rdflib_result(sparql_res):
+        yield from iter_post_process(_rdflib_rows(sparql_res), proto, opt, ordered, terms=True)
+        return
+    if isinstance(sparql_res, (str, bytes)):
+        sparql_res = _parse_tsv(sparql_res)
+    if not hasattr(sparql_res, 'read'):
+        yield from iter_post_process(sparql_res['results']['bindings'], proto, opt, ordered)
+        return
+
+    try:
+        if tsv:
+            bindings = _iter_tsv_bindings(io.TextIOWrapper(sparql_res, encoding='utf-8', newline='\n'))
+        else:
+            bindings = _iter_bindings(sparql_res)
+        yield from iter_post_process(bindings, proto, opt, ordered)
+    finally:
+        sparql_res.close()
+
+
+def dump_sparqlTransformer(_input, fp, options=None, ndjson=False):
+    """Write the output of `sparqlTransformer` in JSON to the file object `fp` (in binary or text mode), writing
+    each root entity as soon as it is yielded by `iter_sparqlTransformer`. Return the number of entities written.
+
+    If `ndjson` is true, the entities are written one per line (newline-delimited JSON), without `@context`.
+    The entities are serialized with orjson, if installed."""
+    query, proto, opt = pre_process(_input, options)
+    dumps = _json_dumps()
+    text = isinstance(fp, io.TextIOBase)
+
+    def write(data):
+        fp.write(data.decode('utf-8') if text else data)
+
+    if ndjson:
+        head, separator, tail = b'', b'\n', b'\n'
+    elif opt['is_json_ld']:
+        head, separator, tail = b'{"@context":' + dumps(opt['context']) + b',"@graph":[', b',', b']}'
+    else:
+        head, separator, tail = b'[', b',', b']'
+
+    count = 0
+    write(head)
+    for entity in _iter_entities(_input, query, proto, opt):
+        write(dumps(entity) if count == 0 else separator + dumps(entity))
+        count += 1
+    if count or not ndjson:
+        write(tail)
+    return count
+
+
+def _json_dumps():
+    """A function serializing a value in JSON (as bytes), with orjson if installed.
+
+    The values orjson cannot serialize (integers above 64 bits) are serialized by the json module. In both cases the
+    non-finite numbers are written as `null`, so that the output does not depend on the installed packages."""
+    try:
+        import orjson
+    except ImportError:
+        return _stdlib_json_dumps
+
+    def dumps(value):
+        try:
+            return orjson.dumps(value)
+        except (orjson.JSONEncodeError, TypeError):
+            return _stdlib_json_dumps(value)
+
+    return dumps
+
+
+def _stdlib_json_dumps(value):
+    try:
+        text = json.dumps(value, ensure_ascii=False, separators=(',', ':'), allow_nan=False)
+    except ValueError:  # NaN or infinity, written as null like orjson does
+        text = json.dumps(_finite(value), ensure_ascii=False, separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+def _finite(value):
+    """The value with its non-finite floats replaced by None"""
+    if isinstance(value, float):
+        return value if value - value == 0 else None
+    if isinstance(value, dict):
+        return {k: _finite(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(v) for v in value]
+    return value
+
+
+def _merge_instances(instances, anchor, stats=None):
+    """Merge the instances with the same anchor value, in order of first appearance.
+
+    If `stats` is given, the merges and the comparisons of values are counted in it."""
+    content = []
+    by_id = {}  # index of the root instances by anchor value
+    indexes = {}  # indexes of the nested anchored lists, shared by all the merges
+    if stats is not None:
+        indexes[_STATS] = stats
+    for inst in instances:
+        _id = _anchor_key(inst[anchor])
+        # search if we have already the same id
+        match = by_id.get(_id)
+        if match is None:  # it is a new one
+            by_id[_id] = inst
+            content.append(inst)
+        else:  # otherwise modify previous one
+            _merge_obj(match, inst, indexes)
+    return content
+
+
+def _iter_grouped_instances(instances, anchor):
+    """Merge the instances with the same anchor value, expecting them to be consecutive.
+    Each merged instance is yielded when the anchor value changes."""
+    current = None
+    current_id = None
+    indexes = {}
+    for inst in instances:
+        _id = _anchor_key(inst[anchor])
+        if current is not None and _id == current_id:
+            _merge_obj(current, inst, indexes)
+            continue
+        if current is not None:
+            yield current
+        current, current_id, indexes = inst, _id, {}
+    if current is not None:
+        yield current
+
+
+ORDER_REGEX = re.compile(r'^(?:(?:ASC|DESC)\s*\()?\s*\?(\w+)\s*\)?$', re.IGNORECASE)
+
+
+def _root_anchor_variable(proto):
+    """Name of the SPARQL variable used as anchor of the root prototype, if any"""
+    anchor = proto.get('$anchor')
+    value = proto.get(anchor) if anchor else None
+    if not isinstance(value, str) or not value.startswith('?'):
+        return None
+    return value[1:].split('$')[0]
+
+
+def _is_ordered_by_anchor(json_query, proto):
+    """Check if the first ORDER BY condition of the query is the anchor variable"""
+    orderby = _as_array(json_query.get('$orderby')) if isinstance(json_query, dict) else []
+    if not orderby:
+        return False
+    match = ORDER_REGEX.match(orderby[0].strip())
+    return match is not None and match.group(1) == _root_anchor_variable(proto)
+
+
+BINDINGS_REGEX = re.compile(r'"bindings"\s*:\s*\[')
+STREAM_CHUNK_SIZE = 65536
+
+
+def _iter_bindings(stream, chunk_size=STREAM_CHUNK_SIZE):
+    """Parse incrementally the `results.bindings` of SPARQL JSON results read from a file-like object"""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = None  # position in buf inside the bindings array, None until it is found
+    eof = False
+
+    while True:
+        if pos is None:
+            match = BINDINGS_REGEX.search(buf)
+            if match:
+                pos = match.end()
+                continue
+            buf = buf[-64:]  # the beginning of the key may be at the end of the buffer
+        else:
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos < len(buf):
+                if buf[pos] == ']':
+                    return
+                try:
+                    binding, pos = decoder.raw_decode(buf, pos)
+                    yield binding
+                    continue
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+            buf = buf[pos:]
+            pos = 0
+
+        if eof:
+            raise ValueError('Truncated SPARQL results: bindings not found or not terminated')
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            buf += text.decode(b'', final=True)
+        else:
+            buf += text.decode(chunk) if isinstance(chunk, bytes) else chunk
+
+
+def _jsonld2query(_input, split=None):
+    """Read the input and extract the query and the prototype.
+
+    If `split` is given (the value of the `splitQuery` option), the queries in which the query can be split
+    (see `_split_query`) and the keys of the properties split are returned too, or None."""
     proto = _input['@graph'] if '@graph' in _input else _input['proto']
     if isinstance(proto, list):
         proto = proto[0]
@@ -152,11 +1061,18 @@ def _jsonld2query(_input):
 
     values_normalized = normalize_values(modifiers.get('$values', None))
     mpk_fun, _temp = _manage_proto_key(proto, _vars, filters, wheres, main_lang, values=values_normalized)
+    branches = []  # the clauses of the properties to split
+    split_keys = []  # the properties having them
     for i, key in enumerate(list(proto)):
+        v = proto[key]
+        n = len(wheres)
         mpk_fun(key, i)
-
-    wheres = [w.strip() for w in wheres]
-    wheres = [w for w in wheres if w]
+        if split is True and (isinstance(v, dict) or isinstance(v, str) and re.search(r'\$(list|asList)\b', v)) \
+                or isinstance(split, list) and key in split:
+            clauses = [w for w in wheres[n:] if w.strip().startswith('OPTIONAL')]
+            if clauses:
+                branches += clauses
+                split_keys.append(key)
 
     _from = ('FROM <%s>' % modifiers['$from']) if '$from' in modifiers else ''
     limit = ('LIMIT %d' % modifiers['$limit']) if (
@@ -171,7 +1087,11 @@ def _jsonld2query(_input):
     having = 'HAVING(%s)' % ' && '.join(_as_array(modifiers['$having'])) if '$having' in modifiers else ''
 
     filterz = list(map(lambda f: 'FILTER(%s)' % f, filters))
-    query = '\n'.join(prefixes) + """
+
+    def select(variables, wheres):
+        wheres = [w.strip() for w in wheres]
+        wheres = [w for w in wheres if w]
+        query = '\n'.join(prefixes) + """
         SELECT %s %s
         %s
         WHERE {
@@ -184,15 +1104,60 @@ def _jsonld2query(_input):
         %s
         %s
         %s
-    """ % (distinct, ' '.join(_vars), _from, ('\n' + INDENT).join(values), ('.\n' + INDENT).join(wheres),
+    """ % (distinct, ' '.join(variables), _from, ('\n' + INDENT).join(values), ('.\n' + INDENT).join(wheres),
            ('\n' + INDENT).join(filterz),
            groupby, having, orderby, limit, offset)
+        return _normalize_query(query)
+
+    query = select(_vars, wheres)
+    if split is None:
+        return proto, query
+    if any(k in modifiers for k in ['$orderby', '$groupby', '$having']) or limit or offset:
+        return proto, query, None
+    required = [w for w in wheres if w not in branches]
+    parts = _split_query(_root_anchor_variable(proto), _vars, required, branches, filters, values_normalized)
+    if parts is None:
+        return proto, query, None
+    return proto, query, ([select(variables, clauses) for variables, clauses in parts], split_keys)
+
+
+SPARQL_VARIABLE_REGEX = re.compile(r'\?\w+')
+
+
+def _split_query(anchor, variables, required, branches, filters, values):
+    """Split the query in a query of the root anchors with the properties not split, and a query for each of the
+    optional clauses in `branches`, returning the anchors with the values of that clause only.
+
+    The results of the single query contain all the combinations of the values of the properties of each anchor,
+    while the split queries return each value once.
+    Return the variables and the clauses of each query, or None if there is no branch, no root anchor, if the query
+    selects expressions (e.g. aggregates) or if the branches are related to each other, to the other clauses
+    (including `$where`) or to the filters by their variables."""
+    if not branches or anchor is None or not all(SPARQL_VARIABLE_REGEX.fullmatch(v) for v in variables):
+        return None
+
+    shared = {'?' + anchor} | set(values)
+    seen = set(SPARQL_VARIABLE_REGEX.findall(' '.join(filters + required)))
+    branch_variables = []
+    for clause in branches:
+        branch = set(SPARQL_VARIABLE_REGEX.findall(clause)) - shared
+        if branch & seen:
+            return None
+        seen |= branch
+        branch_variables.append(branch)
 
+    # the anchors are restricted by the required clauses in all the queries, but their values are selected once
+    split = set().union(*branch_variables)
+    parts = [([v for v in variables if v not in split], required)]
+    for clause, branch in zip(branches, branch_variables):
+        parts.append(([v for v in variables if v == '?' + anchor or v in branch], required + [clause]))
+    return parts
+
+
+def _normalize_query(query):
     query = re.sub(r"\n+", "\n", query)
     query = re.sub(r"\n\s+\n", "\n", query)
-    query = re.sub(r"\.+", ".", query)
-    logger.info(query)
-    return proto, query
+    return re.sub(r"\.+", ".", query)
 
 
 def normalize_values(values):
@@ -208,41 +1173,1018 @@ def normalize_values(values):
     return out
 
 
-def _default_sparql(endpoint):
-    sparql = SPARQLWrapper(endpoint)
-    sparql.setReturnFormat(JSON)
+def _sparql_function(opt, stats=None):
+    """The function executing the SPARQL queries for the given options.
+
+    If `stats` is given, the default client adds to it the time spent in the `decode` stage (the `network` stage is
+    measured by `_run_query`)."""
+    if 'sparqlFunction' in opt:
+        sparql_fun = opt['sparqlFunction']
+    elif 'graph' in opt:
+        sparql_fun = _graph_sparql(opt['graph'])
+    else:
+        sparql_fun = _default_sparql(opt['endpoint'], result_format=opt.get('format', 'json'), stats=stats,
+                                     **_endpoint_options(opt))
+
+    cache = opt.get('resultCache') if 'graph' not in opt else None  # the local results are not cached
+    if cache is not None:
+        uncached_fun = sparql_fun
+
+        def sparql_fun(q):
+            return cache.fetch(opt['endpoint'], q, lambda q: _read_results(uncached_fun(q), opt))
+
+    return sparql_fun
+
+
+def _read_results(sparql_res, opt):
+    """The results read and decoded, if `sparql_res` is a file-like object (as returned by a `sparqlFunction`), so
+    that they can be cached"""
+    if not hasattr(sparql_res, 'read'):
+        return sparql_res
+    try:
+        data = sparql_res.read()
+    finally:
+        sparql_res.close()
+    if opt.get('format') == 'tsv':
+        return data.decode('utf-8') if isinstance(data, bytes) else data
+    return json.loads(data)
+
+
+class ResultCache:
+    """Cache of SPARQL results, to be passed in the `resultCache` option. The results are keyed by endpoint and query.
+
+    Entries expire after `ttl` seconds (never, if `None`), and at most `maxsize` of them are kept in memory, evicting
+    the least recently used. If `path` is given, the entries are also stored in a sqlite database at that path,
+    so that they survive restarts. Concurrent requests of the same query wait for the first one to complete instead of
+    querying the endpoint again.
+
+    Cached results are shared: they must not be modified."""
+
+    def __init__(self, maxsize=1024, ttl=None, path=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expiration time, results)
+        self._in_flight = {}  # key -> Future of the results
+        self._lock = threading.Lock()
+        self._db = None
+        if path is not None:
+            import sqlite3
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, value TEXT)')
+            self._db.commit()
+
+    @staticmethod
+    def key(endpoint, query):
+        import hashlib
+        return hashlib.sha256(('%s\n%s' % (endpoint, query)).encode('utf-8')).hexdigest()
+
+    def get(self, endpoint, query, default=None):
+        """Return the cached results of the query, or `default`"""
+        with self._lock:
+            found, value = self._get(self.key(endpoint, query))
+        return value if found else default
+
+    def put(self, endpoint, query, results):
+        with self._lock:
+            self._put(self.key(endpoint, query), results)
+
+    def fetch(self, endpoint, query, sparql_fun):
+        """Return the cached results of the query, calling `sparql_fun(query)` if they are not cached"""
+        key = self.key(endpoint, query)
+        found, value, future = self._claim(key)
+        if found:
+            return value
+        if future is not None:  # the same query is already running
+            return future.result()
+
+        try:
+            value = sparql_fun(query)
+        except BaseException as e:
+            self._resolve(key, error=e)
+            raise
+        self._resolve(key, value)
+        return value
+
+    async def fetch_async(self, endpoint, query, sparql_fun):
+        """Asynchronous version of `fetch`, where `sparql_fun` can be a coroutine function. The requests of the same
+        query running at the same time, in `fetch` or `fetch_async`, are coalesced as well."""
+        import asyncio
+        import inspect
+
+        key = self.key(endpoint, query)
+        found, value, future = self._claim(key)
+        if found:
+            return value
+        if future is not None:
+            return await asyncio.wrap_future(future)
+
+        try:
+            value = sparql_fun(query)
+            if inspect.isawaitable(value):
+                value = await value
+        except BaseException as e:
+            self._resolve(key, error=e)
+            raise
+        self._resolve(key, value)
+        return value
+
+    def _claim(self, key):
+        """Return whether the query is cached and its results, or the future of the results of the same query
+        running, if any. Otherwise the caller has to execute the query and `_resolve` it."""
+        with self._lock:
+            found, value = self._get(key)
+            if found:
+                return True, value, None
+            future = self._in_flight.get(key)
+            if future is None:
+                from concurrent.futures import Future
+                self._in_flight[key] = Future()
+            return False, None, future
+
+    def _resolve(self, key, value=None, error=None):
+        with self._lock:
+            future = self._in_flight.pop(key)
+            if error is None:
+                self._put(key, value)
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute('DELETE FROM results')
+                self._db.commit()
+
+    def _get(self, key):
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            row = self._db.execute('SELECT expires, value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                # TSV results in bytes are stored as they are, the others in JSON
+                entry = (row[0], row[1] if isinstance(row[1], bytes) else json.loads(row[1]))
+                self._remember(key, entry)
+        if entry is None or (entry[0] is not None and entry[0] <= now):
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def _put(self, key, value):
+        entry = (time.time() + self.ttl if self.ttl is not None else None, value)
+        self._remember(key, entry)
+        # other results (e.g. of rdflib) are kept in memory only
+        if self._db is None or not isinstance(value, (dict, str, bytes)):
+            return
+        try:
+            stored = value if isinstance(value, bytes) else json.dumps(value)
+            self._db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, entry[0], stored))
+            self._db.commit()
+        except Exception:  # the results are returned anyway
+            logger.warning('Cannot store the results in the cache database', exc_info=True)
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+DEFAULT_TIMEOUT = 60
+POOL_SIZE = 16
+GET_MAX_LENGTH = 2048
+ACCEPT_JSON = 'application/sparql-results+json'
+ACCEPT_TSV = 'text/tab-separated-values'
+
+
+class _EndpointClient:
+    """HTTP client for a SPARQL endpoint, keeping a pool of persistent connections shared by all the threads.
+
+    Queries are sent in GET, or in POST when the URL would be longer than `GET_MAX_LENGTH`, accepting
+    gzip and deflate compressed responses."""
+
+    def __init__(self, endpoint, timeout=DEFAULT_TIMEOUT, pool_size=POOL_SIZE):
+        import http.client
+        import urllib.parse
+
+        url = urllib.parse.urlsplit(endpoint)
+        self.endpoint = endpoint
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self._connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self._host = url.hostname
+        self._port = url.port
+        self._path = url.path or '/'
+        self._params = urllib.parse.parse_qsl(url.query)
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def query(self, q, accept=ACCEPT_JSON, stats=None):
+        """Execute the query and return the decoded JSON results.
+
+        If `stats` is given, the decoding time is added to its `decode` stage."""
+        connection, response = self._send(q, accept, 'gzip, deflate')
+        try:
+            body = response.read()
+        except Exception:
+            connection.close()
+            raise
+        self._release(connection)
+
+        encoding = response.getheader('Content-Encoding', '').lower()
+        if encoding == 'gzip':
+            import gzip
+            body = gzip.decompress(body)
+        elif encoding == 'deflate':
+            import zlib
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:  # raw deflate stream, without zlib header
+                body = zlib.decompress(body, -zlib.MAX_WBITS)
+        if accept != ACCEPT_JSON:
+            return body
+        if stats is None:
+            return json.loads(body)
+        start = time.perf_counter()
+        try:
+            return json.loads(body)
+        finally:
+            # the only stage updated by concurrent threads (e.g. in the queries of `valuesChunkSize`)
+            with _stats_lock:
+                _lap(stats, 'decode', start)
+
+    def stream(self, q, accept=ACCEPT_JSON):
+        """Execute the query and return the response as a file-like object, to be closed after use"""
+        connection, response = self._send(q, accept, 'gzip')
+        return _PooledResponse(self, connection, response)
+
+    def _send(self, q, accept, accept_encoding):
+        import http.client
+        import urllib.error
+        import urllib.parse
+
+        headers = {
+            'Accept': accept,
+            'Accept-Encoding': accept_encoding,
+            'User-Agent': 'SPARQLTransformer'
+        }
+        params = urllib.parse.urlencode(self._params + [('query', q)])
+        if len(self._path) + len(params) < GET_MAX_LENGTH:
+            method, url, body = 'GET', self._path + '?' + params, None
+        else:
+            method, url, body = 'POST', self._path, params.encode('utf-8')
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        while True:
+            connection = self._connection()
+            reused = connection.sock is not None
+            try:
+                connection.request(method, url, body, headers)
+                response = connection.getresponse()
+                break
+            except (ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection of the pool: retry on a new one
+            except Exception:
+                connection.close()
+                raise
+
+        if not 200 <= response.status < 300:
+            content = response.read()
+            connection.close()
+            raise urllib.error.HTTPError(self.endpoint, response.status, response.reason, response.headers,
+                                         io.BytesIO(content))
+        return connection, response
+
+    def _connection(self):
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return self._connection_class(self._host, self._port, timeout=self.timeout)
+
+    def _release(self, connection):
+        with self._lock:
+            if len(self._pool) < self.pool_size:
+                self._pool.append(connection)
+                return
+        connection.close()
+
+
+class _PooledResponse(io.RawIOBase):
+    """Response body of a `_EndpointClient`, giving back the connection to the pool when closed"""
+
+    def __init__(self, client, connection, response):
+        super().__init__()
+        self._client = client
+        self._connection = connection
+        self._response = response
+        if response.getheader('Content-Encoding', '').lower() == 'gzip':
+            import gzip
+            self._body = gzip.GzipFile(fileobj=response)
+        else:
+            self._body = response
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._body.read(size)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._response.isclosed():  # the body has been read completely
+            self._client._release(self._connection)
+        else:
+            self._connection.close()
+        super().close()
+
+
+ROUND_ROBIN = 'round-robin'
+LEAST_OUTSTANDING = 'least-outstanding'
+ENDPOINT_COOLDOWN = 30  # default of the `endpointCooldown` option
+LATENCY_WINDOW = 100  # latencies of the last queries used to compute the `hedgePercentile`
+HEDGE_MIN_SAMPLES = 10  # latencies needed before hedging the queries
+
+
+class _EndpointPool:
+    """Client of a list of equivalent SPARQL endpoints, with the same interface of `_EndpointClient`.
+
+    Each query is sent to an endpoint chosen by `policy`: the next one in turn (`ROUND_ROBIN`) or the one with
+    fewer queries running (`LEAST_OUTSTANDING`). An endpoint failing with a connection error, a timeout or a server
+    error is skipped for `cooldown` seconds (unless all the endpoints are failing) and the query is sent to the
+    next one.
+
+    If `hedge` is given, a query not answered after the `hedge` percentile of the latencies of the last queries
+    is sent to a second endpoint too, and the first answer is returned. The other one is discarded."""
+
+    def __init__(self, endpoints, timeout=DEFAULT_TIMEOUT, policy=ROUND_ROBIN, cooldown=ENDPOINT_COOLDOWN, hedge=None):
+        if policy not in (ROUND_ROBIN, LEAST_OUTSTANDING):
+            raise ValueError('Unknown endpoint policy: %s' % policy)
+        self.endpoints = list(endpoints)
+        self.policy = policy
+        self.cooldown = cooldown
+        self.hedge = hedge
+        self._clients = [_endpoint_client(e, timeout) for e in self.endpoints]
+        self._outstanding = [0] * len(self._clients)
+        self._down_until = [0] * len(self._clients)
+        self._latencies = {}
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def query(self, q, accept=ACCEPT_JSON, stats=None):
+        """Execute the query on one of the endpoints and return the decoded JSON results"""
+        return self._call('query', lambda client: client.query(q, accept, stats))
+
+    def stream(self, q, accept=ACCEPT_JSON):
+        """Execute the query on one of the endpoints and return the response as a file-like object"""
+        return self._call('stream', lambda client: client.stream(q, accept), lambda response: response.close())
+
+    def _call(self, kind, fun, discard=None):
+        delay = self._hedge_delay(kind)
+        if delay is not None:
+            return self._hedged(kind, fun, discard, delay)
+        tried = set()
+        while True:
+            try:
+                return self._attempt(self._select(tried), kind, fun)
+            except Exception as e:
+                if not _is_endpoint_failure(e) or len(tried) == len(self._clients):
+                    raise
+
+    def _hedged(self, kind, fun, discard, delay):
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(POOL_SIZE * len(self._clients))
+        tried = set()
+        pending = {self._executor.submit(self._attempt, self._select(tried), kind, fun)}
+        hedged = False
+        error = None
+        while pending:
+            done, pending = wait(pending, None if hedged else delay, FIRST_COMPLETED)
+            if not done:  # no answer in time: send the query to another endpoint too
+                hedged = True
+                if len(tried) < len(self._clients):
+                    pending.add(self._executor.submit(self._attempt, self._select(tried), kind, fun))
+                continue
+            succeeded = [f for f in done if f.exception() is None]
+            if succeeded:
+                _discard_results(pending | set(succeeded[1:]), discard)
+                return succeeded[0].result()
+            error = next(iter(done)).exception()
+            if not _is_endpoint_failure(error):
+                _discard_results(pending, discard)
+                raise error
+            if not pending and len(tried) < len(self._clients):
+                pending.add(self._executor.submit(self._attempt, self._select(tried), kind, fun))
+        raise error
+
+    def _hedge_delay(self, kind):
+        if self.hedge is None or len(self._clients) < 2:
+            return None
+        with self._lock:
+            latencies = sorted(self._latencies.get(kind, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge / 100))]
+
+    def _select(self, tried):
+        """Choose the endpoint of the next attempt among the ones not `tried`, and add it to them"""
+        with self._lock:
+            turn = next(self._turn)
+            candidates = [i for i in range(len(self._clients)) if i not in tried]
+            now = time.monotonic()
+            candidates = [i for i in candidates if self._down_until[i] <= now] or candidates
+            if self.policy == LEAST_OUTSTANDING:
+                chosen = min(candidates, key=lambda i: (self._outstanding[i], (i - turn) % len(self._clients)))
+            else:
+                chosen = min(candidates, key=lambda i: (i - turn) % len(self._clients))
+            self._outstanding[chosen] += 1
+        tried.add(chosen)
+        return chosen
+
+    def _attempt(self, i, kind, fun):
+        start = time.perf_counter()
+        try:
+            result = fun(self._clients[i])
+        except Exception as e:
+            with self._lock:
+                self._outstanding[i] -= 1
+                if _is_endpoint_failure(e):
+                    self._down_until[i] = time.monotonic() + self.cooldown
+            raise
+        with self._lock:
+            self._outstanding[i] -= 1
+            self._down_until[i] = 0
+            if kind not in self._latencies:
+                from collections import deque
+                self._latencies[kind] = deque(maxlen=LATENCY_WINDOW)
+            self._latencies[kind].append(time.perf_counter() - start)
+        return result
+
+
+def _is_endpoint_failure(error):
+    """Whether the error is due to the endpoint (and the query can be sent to another one)"""
+    import http.client
+    import urllib.error
+
+    if isinstance(error, urllib.error.HTTPError):
+        return error.code >= 500 or error.code == 429
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+
+def _discard_results(futures, discard):
+    """Release the results of the `futures` that will not be used, when they complete"""
+    if discard is None:
+        return
+    for future in futures:
+        future.add_done_callback(lambda f: f.exception() is None and discard(f.result()))
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def _endpoint_client(endpoint, timeout=DEFAULT_TIMEOUT, policy=ROUND_ROBIN, cooldown=ENDPOINT_COOLDOWN, hedge=None):
+    """The client of the endpoint, shared by all the calls with the same endpoint and timeout.
+
+    If `endpoint` is a list of endpoints, the client is a `_EndpointPool` with the given `policy`, `cooldown` and
+    `hedge` percentile."""
+    is_pool = isinstance(endpoint, (list, tuple))
+    key = (tuple(endpoint), timeout, policy, cooldown, hedge) if is_pool else (endpoint, timeout)
+    with _clients_lock:
+        client = _clients.get(key)
+    if client is None:
+        # a pool gets the clients of its endpoints: it is created without holding the lock
+        client = _EndpointPool(endpoint, timeout, policy, cooldown, hedge) if is_pool else \
+            _EndpointClient(endpoint, timeout)
+        with _clients_lock:
+            client = _clients.setdefault(key, client)
+    return client
+
+
+def _endpoint_options(opt):
+    """The arguments of `_endpoint_client` in the options"""
+    return {'timeout': opt.get('timeout', DEFAULT_TIMEOUT), 'policy': opt.get('endpointPolicy', ROUND_ROBIN),
+            'cooldown': opt.get('endpointCooldown', ENDPOINT_COOLDOWN), 'hedge': opt.get('hedgePercentile')}
+
+
+def _default_sparql(endpoint, timeout=DEFAULT_TIMEOUT, result_format='json', stats=None, **pool_options):
+    client = _endpoint_client(endpoint, timeout, **pool_options)
+    if result_format != 'tsv' and stats is not None:
+        return lambda q: client.query(q, stats=stats)
+    if result_format != 'tsv':
+        return client.query
 
     def exec_query(q):
-        sparql.setQuery(q)
-        return sparql.query().convert()
+        return client.query(q, ACCEPT_TSV).decode('utf-8')
+
+    return exec_query
+
+
+def _graph_sparql(graph):
+    """A function executing the queries on an rdflib `graph`, returning its results as they are"""
+    def exec_query(q):
+        res = graph.query(q)
+        res.bindings  # the query is evaluated when its bindings are first read: read them now
+        return res
+
+    return exec_query
+
+
+def _is_rdflib_result(sparql_res):
+    return not isinstance(sparql_res, (dict, str, bytes)) and hasattr(sparql_res, 'vars')
+
+
+def _rdflib_rows(sparql_res):
+    """The lines of an rdflib query result, as dicts of rdflib terms by variable name"""
+    # the bindings of rdflib keep their terms in `_d`: reading it is much faster than their `Mapping` interface
+    return ({str(k): v for k, v in getattr(b, '_d', b).items()} for b in sparql_res.bindings)
+
+
+def _rdflib_cells(line):
+    """A line of rdflib terms in the format of the SPARQL JSON results"""
+    cells = {}
+    for variable, term in line.items():
+        cell = {'value': str(term)}
+        if getattr(term, 'datatype', None) is not None:
+            cell['datatype'] = str(term.datatype)
+        if getattr(term, 'language', None) is not None:
+            cell['xml:lang'] = term.language
+        cells[variable] = cell
+    return cells
+
+
+def _default_sparql_async(opt):
+    import asyncio
+
+    try:
+        import aiohttp
+    except ImportError:
+        aiohttp = None
+    if aiohttp is None or not isinstance(opt['endpoint'], str):  # the lists of endpoints are queried by a pool
+        sync_fun = _default_sparql(opt['endpoint'], result_format=opt.get('format', 'json'), **_endpoint_options(opt))
+
+        async def exec_in_thread(q):
+            return await asyncio.get_running_loop().run_in_executor(None, sync_fun, q)
+
+        return exec_in_thread
+
+    import urllib.parse
+
+    tsv = opt.get('format') == 'tsv'
+    endpoint = opt['endpoint']
+    url = urllib.parse.urlsplit(endpoint)
+    path, endpoint_params = url.path or '/', urllib.parse.parse_qsl(url.query)
+
+    async def exec_query(q):
+        session = opt.get('session') or _async_session(aiohttp, endpoint)
+        headers = {'Accept': ACCEPT_TSV if tsv else ACCEPT_JSON}
+        timeout = aiohttp.ClientTimeout(total=opt.get('timeout', DEFAULT_TIMEOUT))
+        # in GET or POST as `_EndpointClient` does
+        if len(path) + len(urllib.parse.urlencode(endpoint_params + [('query', q)])) < GET_MAX_LENGTH:
+            request = session.get(endpoint, params={'query': q}, headers=headers, timeout=timeout)
+        else:
+            request = session.post(endpoint, data={'query': q}, headers=headers, timeout=timeout)
+        async with request as response:
+            response.raise_for_status()
+            return await (response.text() if tsv else response.json(content_type=None))
 
     return exec_query
 
 
+_async_sessions = weakref.WeakKeyDictionary()  # event loop -> {endpoint: aiohttp session}
+
+
+def _async_session(aiohttp, endpoint):
+    """The aiohttp session of the endpoint in the running event loop, shared by all the queries to the endpoint
+    so that their connections are reused"""
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        sessions = _async_sessions.setdefault(loop, {})
+    session = sessions.get(endpoint)
+    if session is None or session.closed:
+        session = sessions[endpoint] = aiohttp.ClientSession()
+    return session
+
+
+def _parse_tsv(text):
+    """Parse SPARQL results in TSV, returning them in the same structure of the SPARQL JSON results"""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    variables = _tsv_variables(lines[0]) if lines else []
+    return {
+        'head': {'vars': variables},
+        'results': {'bindings': list(_iter_tsv_bindings(lines))}
+    }
+
+
+def _tsv_variables(header):
+    return [v.strip()[1:] for v in header.rstrip('\r\n').split('\t')]
+
+
+def _iter_tsv_bindings(lines):
+    """Parse the bindings of SPARQL results in TSV, from an iterable of lines starting with the header"""
+    lines = iter(lines)
+    header = next(lines, None)
+    if header is None:
+        return
+    variables = _tsv_variables(header)
+    cells = {}  # parsed terms, shared by the bindings: results repeat the same terms a lot
+    for line in lines:
+        binding = {}
+        for var, term in zip(variables, line.rstrip('\r\n').split('\t')):
+            if term:
+                cell = cells.get(term)
+                if cell is None:
+                    if len(cells) >= TSV_TERMS_CACHE_SIZE:
+                        cells.clear()
+                    cell = cells[term] = _parse_tsv_term(term)
+                binding[var] = cell
+        yield binding
+
+
+TSV_TERMS_CACHE_SIZE = 100000
+
+
+TSV_INTEGER_REGEX = re.compile(r'^[+-]?\d+$')
+TSV_DECIMAL_REGEX = re.compile(r'^[+-]?\d*\.\d+$')
+TSV_DOUBLE_REGEX = re.compile(r'^[+-]?(?:\d+\.?\d*|\.\d+)[eE][+-]?\d+$')
+TSV_ESCAPE_REGEX = re.compile(r'\\(?:u([0-9A-Fa-f]{4})|U([0-9A-Fa-f]{8})|(.))')
+TSV_ESCAPES = {'t': '\t', 'n': '\n', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+
+def _tsv_unescape(match):
+    code = match.group(1) or match.group(2)
+    if code:
+        return chr(int(code, 16))
+    return TSV_ESCAPES.get(match.group(3), match.group(3))
+
+
+def _parse_tsv_term(term):
+    """Parse a RDF term in TSV, returning it as a cell of SPARQL JSON results"""
+    first = term[0]
+    if first == '<':
+        return {'type': 'uri', 'value': term[1:-1]}
+    if first == '"' or first == "'":
+        end = term.rindex(first)
+        value = term[1:end]
+        if '\\' in value:
+            value = TSV_ESCAPE_REGEX.sub(_tsv_unescape, value)
+        cell = {'type': 'literal', 'value': value}
+        suffix = term[end + 1:]
+        if suffix.startswith('@'):
+            cell['xml:lang'] = suffix[1:]
+        elif suffix.startswith('^^<'):
+            cell['datatype'] = suffix[3:-1]
+        return cell
+    if term.startswith('_:'):
+        return {'type': 'bnode', 'value': term[2:]}
+    if term == 'true' or term == 'false':
+        return {'type': 'literal', 'value': term, 'datatype': xsd('boolean')}
+    if TSV_INTEGER_REGEX.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': xsd('integer')}
+    if TSV_DECIMAL_REGEX.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': xsd('decimal')}
+    if TSV_DOUBLE_REGEX.match(term):
+        return {'type': 'literal', 'value': term, 'datatype': xsd('double')}
+    return {'type': 'literal', 'value': term}
+
+
 def _parse_prefixes(prefixes):
     return list(map(lambda key: 'PREFIX %s: <%s>' % (key, prefixes[key]), prefixes.keys()))
 
 
+VALUES_LANG_REGEX = re.compile(r'^.+@[a-z]{2,3}(_[A-Z]{2})?$')
+
+
 def parse_values(values):
-    res = []
-    for p in list(values):
-        __v = []
-
-        for v in _as_array(values[p]):
-            if type(v) == str:
-                if v.startswith('http'):
-                    __v.append(f'<{v}>')
-                elif ':' in v:
-                    __v.append(v)
-                elif re.match(r'^.+@[a-z]{2,3}(_[A-Z]{2})?$', v):
-                    vv, langtag = v.split('@')
-                    __v.append(f'"{vv}"@{langtag}')
-                else:
-                    __v.append(f'"{v}"')
-            else:
-                __v.append(v)
-        res.append('VALUES %s {%s}' % (_sparql_var(p), ' '.join(map(str, __v))))
-    return res
+    return ['VALUES %s {%s}' % (_sparql_var(p), ' '.join(map(_values_term, _as_array(values[p]))))
+            for p in list(values)]
+
+
+def _values_term(v):
+    if type(v) != str:
+        return str(v)
+    if v.startswith('http'):
+        return f'<{v}>'
+    if ':' in v:
+        return v
+    if VALUES_LANG_REGEX.match(v):
+        vv, langtag = v.split('@')
+        return f'"{vv}"@{langtag}'
+    return f'"{v}"'
+
+
+IRI_ESCAPE_REGEX = re.compile(r'[\x00-\x20<>"{}|^`\\]')
+PREFIXED_NAME_REGEX = re.compile(r'^[A-Za-z][\w.-]*:[\w-]*$')
+LANG_LITERAL_REGEX = re.compile(r'^(.+)@([a-z]{2,3}(?:[_-][A-Z]{2})?)$', re.DOTALL)
+LITERAL_ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r'}
+
+
+def _sparql_term(value):
+    """The SPARQL term of a parameter value, with the rules of `parse_values` but escaping the IRIs and literals"""
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if not isinstance(value, str):
+        return str(value)
+    if value.startswith('http'):
+        return '<%s>' % IRI_ESCAPE_REGEX.sub(lambda m: '%%%02X' % ord(m.group()), value)
+    if PREFIXED_NAME_REGEX.match(value):
+        return value
+    lang = LANG_LITERAL_REGEX.match(value)
+    if lang:
+        value = lang.group(1)
+    literal = '"%s"' % ''.join(LITERAL_ESCAPES.get(c, c) for c in value)
+    return '%s@%s' % (literal, lang.group(2)) if lang else literal
+
+
+def _sparql_terms(value, separator):
+    return separator.join(map(_sparql_term, value)) if isinstance(value, (list, tuple)) else _sparql_term(value)
+
+
+def _parse_proto_variable(variable, options):
+    """Split a prototype value like `?var$list$accept:...$langTag:...` in the variable name and the
+    options for `_to_jsonld_value`"""
+    variable = variable[1:]
+    accept = None
+    langTag = options['langTag']
+    asList = '$list' in variable or '$asList' in variable
+    variable = re.sub(r'\$(asL|l)ist', '', variable)
+
+    if "$accept:" in variable:
+        temp = variable.split('$accept:')
+        variable = temp[0]
+        accept = temp[1]
+    if "$langTag:" in variable:
+        temp = variable.split('$langTag:')
+        variable = temp[0]
+        langTag = temp[1]
+
+    opt = options.copy()
+    opt['accept'] = accept
+    opt['langTag'] = langTag
+    opt['list'] = asList
+    return variable, opt
+
+
+_CONSTANT, _VARIABLE, _COLUMN, _FORMATTED_COLUMN, _TERM, _OBJECT, _LIST = range(7)
+
+
+def _compile_proto(proto, options, columns=None, terms=False):
+    """Compile the prototype in a function that builds the instance of a single line of results.
+
+    The compiled function gives the same result of `_sparql2proto`, but the prototype is parsed only once
+    and the instances are built directly instead of deep-copying the prototype.
+    If `columns` (as returned by `_to_columns`) are given, the function takes the index of the line instead.
+    If `terms` is true, the function takes a line of rdflib terms (see `_rdflib_rows`) instead.
+
+    Each variable keeps a memo of the converted typed and language-tagged literals, so that the terms repeated
+    across the lines are converted once and the equal language-tagged literals are the same object."""
+    if terms:
+        from rdflib import Literal
+
+    steps = []
+    for k, v in proto.items():
+        if isinstance(v, dict):
+            sub_build = _compile_proto(v, options, columns, terms)
+            steps.append((k, _OBJECT, (sub_build, v.get('$list', v.get('$asList', False)))))
+        elif isinstance(v, list):
+            steps.append((k, _LIST, v))
+        elif isinstance(v, str) and v.startswith('?'):
+            variable, opt = _parse_proto_variable(v, options)
+            if terms:
+                steps.append((k, _TERM, (variable, opt, {})))
+            elif columns is None:
+                steps.append((k, _VARIABLE, (variable, opt, {})))
+            elif variable in columns and opt['list']:  # the list must be a new one in each instance
+                steps.append((k, _COLUMN, columns[variable] + (opt,)))
+            elif variable in columns:
+                steps.append((k, _FORMATTED_COLUMN, _format_column(*columns[variable], opt)))
+        else:
+            steps.append((k, _CONSTANT, v))
+
+    def build(line):
+        instance = {}
+        for k, kind, arg in steps:
+            if kind == _VARIABLE:
+                variable, opt, memo = arg
+                cell = line.get(variable)
+                if cell is not None:
+                    if 'datatype' not in cell and 'xml:lang' not in cell:
+                        value = _format_value(cell['value'], None, opt)
+                    else:
+                        key = (cell['value'], cell.get('datatype'), cell.get('xml:lang'))
+                        value = memo.get(key, _UNBOUND)
+                        if value is _UNBOUND:
+                            value = _to_jsonld_value(cell, opt)
+                            if len(memo) < TERM_MEMO_SIZE:
+                                memo[key] = value
+                        if type(value) is list:  # the lists are never shared, they can grow when merging
+                            value = value[:]
+                    if value is not None:
+                        instance[k] = value
+            elif kind == _TERM:
+                variable, opt, memo = arg
+                term = line.get(variable)
+                if term is not None:
+                    if type(term) is not Literal or (term.datatype is None and term.language is None):
+                        value = _format_value(str(term), None, opt)
+                    else:
+                        value = memo.get(term, _UNBOUND)
+                        if value is _UNBOUND:
+                            datatype = None if term.datatype is None else str(term.datatype)
+                            value = _typed_value(str(term), datatype, term.language, opt)
+                            if len(memo) < TERM_MEMO_SIZE:
+                                memo[term] = value
+                        if type(value) is list:
+                            value = value[:]
+                    if value is not None:
+                        instance[k] = value
+            elif kind == _FORMATTED_COLUMN:
+                value = arg[line]
+                if value is not None:
+                    instance[k] = value
+            elif kind == _COLUMN:
+                values, langs, opt = arg
+                value = values[line]
+                if value is not _UNBOUND:
+                    value = _format_value(value, langs[line] if langs else None, opt)
+                    if value is not None:
+                        instance[k] = value
+            elif kind == _CONSTANT:
+                instance[k] = arg
+            elif kind == _OBJECT:
+                sub_build, obj_as_list = arg
+                obj = sub_build(line)
+                if not _is_empty_obj(obj):
+                    instance[k] = [obj] if obj_as_list else obj
+            else:  # lists are rare in prototypes, they follow the generic path
+                temp = {k: copy.deepcopy(arg)}
+                _fit_in(temp, _rdflib_cells(line) if terms else line, options)(k)
+                if k in temp:
+                    instance[k] = temp[k]
+        return instance
+
+    return build
+
+
+def _has_list(proto):
+    """Check if the prototype contains lists"""
+    return any(isinstance(v, list) or (isinstance(v, dict) and _has_list(v)) for v in proto.values())
+
+
+_UNBOUND = object()
+TERM_MEMO_SIZE = 10000  # converted terms remembered by each variable of the prototype
+
+
+def _to_columns(bindings):
+    """Convert the bindings in columns: for each variable, the list of the values (`_UNBOUND` if absent in a line)
+    and the list of the languages (None if there are no languages in the column).
+    The values are converted according to their datatype one column at a time."""
+    return {var: _to_column([b.get(var, _NO_CELL) for b in bindings]) for var in set().union(*bindings)}
+
+
+def _tsv_columns(text):
+    """Parse SPARQL results in TSV directly in columns (see `_to_columns`), returning them with the number of lines"""
+    if isinstance(text, bytes):
+        text = text.decode('utf-8')
+    lines = text.split('\n')
+    if lines[-1] == '':
+        lines.pop()
+    if not lines:
+        return {}, 0
+    variables = _tsv_variables(lines[0])
+    rows = [line.rstrip('\r').split('\t') for line in lines[1:]]
+    columns = {}
+    for var, terms in zip(variables, itertools.zip_longest(*rows, fillvalue='')):
+        column = _tsv_uniform_column(terms) if terms and '' not in terms else None
+        if column is None:
+            cells = {term: _parse_tsv_term(term) if term else _NO_CELL for term in set(terms)}
+            if cells.keys() == {''}:
+                continue
+            column = _to_column(list(map(cells.__getitem__, terms)))
+        columns[var] = column
+    return columns, len(rows)
+
+
+def _tsv_uniform_column(terms):
+    """Parse at once a TSV column made only of IRIs, only of integers, or only of literals with the same datatype.
+    Return None for the other columns."""
+    first = terms[0]
+    if first[0] == '<':
+        if all(map(_is_tsv_iri, terms)):
+            return [t[1:-1] for t in terms], None
+    elif first[0] == '"':
+        end = first.rindex('"')
+        suffix = first[end:]
+        if suffix.startswith('"^^<') and all(map(operator.methodcaller('endswith', suffix), terms)) \
+                and all(map(_is_tsv_quoted, terms)):
+            end = -len(suffix)
+            values = [t[1:end] for t in terms]
+            if not any(map(_has_tsv_escape, values)):
+                converted = _convert_column(values, suffix[4:-1])
+                return (values if converted is None else converted), None
+    elif TSV_INTEGER_REGEX.match(first):
+        if all(map(TSV_INTEGER_REGEX.match, terms)):
+            return list(map(int, terms)), None
+    return None
+
+
+_is_tsv_iri = operator.methodcaller('startswith', '<')
+_is_tsv_quoted = operator.methodcaller('startswith', '"')
+_has_tsv_escape = operator.methodcaller('__contains__', '\\')
+
+
+def _to_column(cells):
+    values = list(map(_get_value, cells))
+    datatypes = list(map(_get_datatype, cells))
+    distinct = set(datatypes)
+    if None in distinct:  # typed literals have no language
+        langs = list(map(_get_lang, cells))
+        if not any(langs):
+            langs = None
+    else:
+        langs = None
+
+    for datatype in distinct - {None}:
+        if len(distinct) == 1:  # the usual case: a single datatype for the whole column
+            converted = _convert_column(values, datatype)
+            if converted is not None:
+                values = converted
+            continue
+        indexes = [i for i, d in enumerate(datatypes) if d == datatype]
+        converted = _convert_column([values[i] for i in indexes], datatype)
+        if converted is not None:
+            for i, value in zip(indexes, converted):
+                values[i] = value
+    return values, langs
+
+
+_NO_CELL = {'value': _UNBOUND}
+_get_value = operator.itemgetter('value')
+_get_lang = operator.methodcaller('get', 'xml:lang')
+_get_datatype = operator.methodcaller('get', 'datatype')
+
+
+def _format_column(values, langs, options):
+    """Apply `_format_value` to a whole column, returning None for the values to be skipped"""
+    if langs is None and options.get('accept') is None and not options['list']:
+        return [None if v is _UNBOUND else v for v in values]
+    if langs is None:
+        return [None if v is _UNBOUND else _format_value(v, None, options) for v in values]
+    if options['list']:  # each value is a new list
+        return [None if v is _UNBOUND else _format_value(v, lang, options) for v, lang in zip(values, langs)]
+
+    memo = {}  # the equal language-tagged literals are the same object
+
+    def format_value(value, lang):
+        if value is _UNBOUND:
+            return None
+        if lang is None:
+            return _format_value(value, None, options)
+        key = (value, lang)
+        formatted = memo.get(key, _UNBOUND)
+        if formatted is _UNBOUND:
+            formatted = _format_value(value, lang, options)
+            if len(memo) < TERM_MEMO_SIZE:
+                memo[key] = formatted
+        return formatted
+
+    return list(map(format_value, values, langs))
+
+
+def _convert_column(values, datatype):
+    """Convert all the values of the same datatype as `_to_jsonld_value` does, or return None
+    if the datatype does not require a conversion"""
+    if datatype == xsd('boolean'):
+        return [v not in ['false', '0', 0, 'False', False] for v in values]
+    if datatype in XSD_INT_TYPES:
+        return list(map(int, values))
+    if datatype in XSD_FLOAT_TYPES:
+        return [float(v.replace('INF', 'inf')) for v in values]
+    return None
 
 
 def _sparql2proto(line, proto, options):
@@ -287,20 +2229,7 @@ def _fit_in(instance, line, options):
         if not variable.startswith('?'):
             return
 
-        variable = variable[1:]
-        accept = None
-        langTag = options['langTag']
-        asList = '$list' in variable or '$asList' in variable
-        variable = re.sub(r'\$(asL|l)ist', '', variable)
-
-        if "$accept:" in variable:
-            temp = variable.split('$accept:')
-            variable = temp[0]
-            accept = temp[1]
-        if "$langTag:" in variable:
-            temp = variable.split('$langTag:')
-            variable = temp[0]
-            langTag = temp[1]
+        variable, opt = _parse_proto_variable(variable, options)
 
         # variable not in result, delete from
         if variable not in line:
@@ -309,10 +2238,6 @@ def _fit_in(instance, line, options):
             else:
                 instance.pop(k)
         else:
-            opt = options.copy()
-            opt['accept'] = accept
-            opt['langTag'] = langTag
-            opt['list'] = asList
             instance[k] = _to_jsonld_value(line[variable], opt)
 
             if instance[k] is None:
@@ -357,16 +2282,25 @@ known_types = {
 
 def _to_jsonld_value(_input, options):
     """Prepare the output managing languages and datatypes"""
-    value = _input['value']
-    if 'datatype' in _input:
-        if _input['datatype'] == xsd('boolean'):
+    return _typed_value(_input['value'], _input.get('datatype'), _input.get('xml:lang'), options)
+
+
+def _typed_value(value, datatype, lang, options):
+    """Prepare the output of a term given its value, datatype and language"""
+    if datatype is not None:
+        if datatype == xsd('boolean'):
             value = value not in ['false', '0', 0, 'False', False]
-        elif _input['datatype'] in XSD_INT_TYPES:
+        elif datatype in XSD_INT_TYPES:
             value = int(value)
-        elif _input['datatype'] in XSD_FLOAT_TYPES:
+        elif datatype in XSD_FLOAT_TYPES:
             value = value.replace('INF', 'inf')
             value = float(value)
 
+    return _format_value(value, lang, options)
+
+
+def _format_value(value, lang, options):
+    """Prepare the output of a value already converted according to its datatype"""
     # I can't accept 0 if I want a string
     if 'accept' in options and options.get('accept') is not None:
         if type(value) not in known_types[options.get('accept')]:
@@ -377,21 +2311,91 @@ def _to_jsonld_value(_input, options):
         return [value] if options['list'] else value
 
     # if here, it is a string or a date, that are not parsed
-    if 'xml:lang' in _input and options['langTag'] != 'hide':
-        lang = _input['xml:lang']
-
+    if lang and options['langTag'] != 'hide':
         voc = options['voc']
-        if lang:
-            return {
-                voc['lang']: lang,
-                voc['value']: value
-            }
+        return {
+            voc['lang']: lang,
+            voc['value']: value
+        }
     return [value] if options['list'] else value
 
 
-def _merge_obj(base, addition):
+def _anchor_key(value):
+    """Hashable key for an anchor value, equal for anchor values that compare equal"""
+    return _fingerprint(value)
+
+
+def _fingerprint(value):
+    """Hashable structural fingerprint of a value: equal for values that compare equal (NaN included),
+    regardless of the order of the keys of the objects"""
+    if isinstance(value, dict):
+        return frozenset([(k, _fingerprint(v)) for k, v in value.items()])
+    if isinstance(value, list):
+        return tuple(map(_fingerprint, value))
+    if value != value:  # NaN
+        return _NAN
+    return value
+
+
+_NAN = object()
+_STATS = '$stats'  # key of the statistics in the indexes of `_merge_obj`
+
+
+def _anchored_index(b, anchor, indexes):
+    """Return the index by anchor value of the objects in the list `b`, building it at the first access.
+
+    The index is stored in `indexes`, that keeps a reference to the list so that its id is not reused."""
+    key = (id(b), anchor)
+    entry = indexes.get(key)
+    if entry is None:
+        index = {}
+        for x in b:
+            if isinstance(x, dict) and anchor in x:
+                index.setdefault(_anchor_key(x[anchor]), x)
+        entry = indexes[key] = (b, index)
+    return entry[1]
+
+
+def _list_fingerprints(b, indexes):
+    """Return the fingerprints of the values in the list `b`, computing them at the first access:
+    the count of each fingerprint and the fingerprint of each value by id.
+
+    They are stored in `indexes` as in `_anchored_index`."""
+    key = (id(b), None)
+    entry = indexes.get(key)
+    if entry is None:
+        fingerprints = {id(x): _fingerprint(x) for x in b}
+        entry = indexes[key] = (b, Counter(fingerprints[id(x)] for x in b), fingerprints)
+    return entry[1:]
+
+
+def _add_fingerprint(b, x, indexes, fingerprint=None):
+    """Update the fingerprints of the list `b` (if computed) after appending `x` or merging into it"""
+    entry = indexes.get((id(b), None))
+    if entry is None:
+        return
+    _, counts, fingerprints = entry
+    old = fingerprints.get(id(x))
+    if old is not None:
+        counts[old] -= 1
+        if not counts[old]:
+            del counts[old]
+    fingerprints[id(x)] = fingerprint = _fingerprint(x) if fingerprint is None else fingerprint
+    counts[fingerprint] += 1
+
+
+def _merge_obj(base, addition, indexes=None):
     """Merge base and addition, by defining/adding in an array the values in addition to the base object.
-    Return the base object merged."""
+    Return the base object merged.
+
+    `indexes` caches the lookup tables of the anchored lists; pass the same dict when merging several
+    additions in the same base, so that each list is scanned only once. It can also hold the statistics
+    (see `_merge_instances`)."""
+    if indexes is None:
+        indexes = {}
+    stats = indexes.get(_STATS)
+    if stats is not None:
+        stats['merges'] += 1
     for k in list(addition):
         if k == '$anchor':
             continue
@@ -413,20 +2417,35 @@ def _merge_obj(base, addition):
 
         if isinstance(b, list):
             if anchor:
-                same_ids = [x for x in b if anchor in x and a[anchor] == x[anchor]]
-                if len(same_ids) > 0:
-                    _merge_obj(same_ids[0], a)
+                index = _anchored_index(b, anchor, indexes)
+                _id = _anchor_key(a[anchor])
+                same_id = index.get(_id)
+                if same_id is not None:
+                    _merge_obj(same_id, a, indexes)
+                    _add_fingerprint(b, same_id, indexes)
                     continue
-
-            if not any([_deepequals(x, a) for x in b]):
+                # no value in the list has the same anchor value, so none is equal to `a`
+                b.append(a)
+                index[_id] = a
+                _add_fingerprint(b, a, indexes)
+                continue
+
+            counts, _ = _list_fingerprints(b, indexes)
+            fingerprint = _fingerprint(a)
+            if stats is not None:
+                stats['comparisons'] += 1
+            if fingerprint not in counts:
                 b.append(a)
+                _add_fingerprint(b, a, indexes, fingerprint)
             continue
 
+        if stats is not None:
+            stats['comparisons'] += 1
         if _deepequals(a, b):
             continue
 
         if anchor and anchor in b and a[anchor] == b[anchor]:  # same ids
-            _merge_obj(b, a)
+            _merge_obj(b, a, indexes)
         else:
             base[k] = [b, a]
 
@@ -475,8 +2494,13 @@ def _sparql_var(_input):
     return _input if _input.startswith('?') else '?' + _input
 
 
-def _manage_proto_key(proto, vars=[], filters=[], wheres=[], main_lang=None, prefix="v", prev_root=None, values={}):
+def _manage_proto_key(proto, vars=None, filters=None, wheres=None, main_lang=None, prefix="v", prev_root=None,
+                      values=None):
     """Parse a single key in prototype"""
+    vars = [] if vars is None else vars
+    filters = [] if filters is None else filters
+    wheres = [] if wheres is None else wheres
+    values = {} if values is None else values
     _rootId, _blockRequired = _compute_root_id(proto, prefix)
     _rootId = _rootId or prev_root or '?id'
 
@@ -615,7 +2639,25 @@ def clean_recursively(instance):
         instance.pop('$list', None)  # remove $anchor
         instance.pop('$asList', None)  # remove $anchor
         for k, v in instance.items():
-            clean_recursively(v)
+            if isinstance(v, (dict, list)):
+                clean_recursively(v)
+
+
+def _compile_clean(proto):
+    """Compile `clean_recursively` for the instances of the prototype, visiting only the properties
+    that can contain objects"""
+    nested = [k for k, v in proto.items() if isinstance(v, (dict, list))]
+
+    def clean(instance):
+        instance.pop('$anchor', None)
+        instance.pop('$list', None)
+        instance.pop('$asList', None)
+        for k in nested:
+            v = instance.get(k)
+            if v is not None:
+                clean_recursively(v)
+
+    return clean
 
 
 def _prepare_orderby(array=None, keyword='ORDER BY'):
@@ -652,4 +2694,132 @@ def _as_array(v):
 
 
 def _deepequals(a, b):
-    return a == b or dumps(a) == dumps(b)
+    return a == b or _fingerprint(a) == _fingerprint(b)
+
+
+def main(argv=None):
+    """Command line interface, run with `python -m SPARQLTransformer`.
+
+    Execute the JSON queries in the given files, directories (their `*.json` files, recursively) or glob patterns,
+    `--workers` at the same time, and write their output in a directory or a NDJSON stream (one line by query).
+    A summary of the throughput and of the latency of the queries is printed in the standard error.
+    Return the exit status: 1 if a query failed, 0 otherwise."""
+    import argparse
+    import sys
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    parser = argparse.ArgumentParser(prog='python -m SPARQLTransformer',
+                                     description='Execute SPARQL Transformer queries in JSON files.')
+    parser.add_argument('queries', nargs='+', metavar='query',
+                        help='a JSON query file, a directory containing them or a glob pattern')
+    parser.add_argument('-w', '--workers', type=int, default=BATCH_CONCURRENCY,
+                        help='number of queries executed at the same time (default: %(default)s)')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('-o', '--output', metavar='DIR',
+                        help='write the output of each query in DIR, in a file with the name of the query file')
+    output.add_argument('--ndjson', metavar='FILE', default='-',
+                        help='write a JSON line with the output of each query in FILE (default: standard output)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='write the SPARQL queries (in .rq files with --output) without executing them')
+    parser.add_argument('-e', '--endpoint', action='append',
+                        help='the SPARQL endpoint; repeat it for a list of equivalent endpoints')
+    parser.add_argument('--format', choices=['json', 'tsv'], help='format of the results requested to the endpoint')
+    parser.add_argument('--timeout', type=float, help='timeout in seconds of the requests to the endpoint')
+    args = parser.parse_args(argv)
+
+    files = list(dict.fromkeys(_query_files(args.queries)))
+    if not files:
+        parser.error('no query file found')
+    options = {}
+    if args.endpoint:
+        options['endpoint'] = args.endpoint[0] if len(args.endpoint) == 1 else args.endpoint
+    if args.format:
+        options['format'] = args.format
+    if args.timeout:
+        options['timeout'] = args.timeout
+
+    def run(path, name):
+        """Execute a query, returning its NDJSON record (if not written in the output directory), the number of
+        entities in output and the time elapsed"""
+        start = time.perf_counter()
+        with open(path) as f:
+            json_query = json.load(f)
+        record, count = None, 0
+        if args.dry_run:
+            sparql = pre_process(json_query, options)[0]
+            if args.output:
+                with open(_output_path(args.output, name, '.rq'), 'w') as f:
+                    f.write(sparql)
+            else:
+                record = {'query': path, 'sparql': sparql}
+        elif args.output:
+            with open(_output_path(args.output, name, '.json'), 'wb') as f:
+                count = dump_sparqlTransformer(json_query, f, options)
+        else:
+            result = sparqlTransformer(json_query, options)
+            count = len(result['@graph'] if isinstance(result, dict) else result)
+            record = {'query': path, 'output': result}
+        return record, count, time.perf_counter() - start
+
+    dumps = _json_dumps()
+    out = None
+    if not args.output:
+        out = sys.stdout.buffer if args.ndjson == '-' else open(args.ndjson, 'wb')
+    latencies, entities, failed = [], 0, 0
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max(1, args.workers)) as executor:
+            futures = {executor.submit(run, path, name): path for path, name in files}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    record, count, elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    print('%s: %s: %s' % (path, type(e).__name__, e), file=sys.stderr)
+                    record = {'query': path, 'error': str(e)} if out is not None else None
+                else:
+                    latencies.append(elapsed)
+                    entities += count
+                if record is not None:
+                    out.write(dumps(record) + b'\n')
+                    out.flush()
+    finally:
+        if out is not None and out is not sys.stdout.buffer:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print('%d queries (%d failed), %d entities in %.3fs: %.1f queries/s' %
+          (len(files), failed, entities, elapsed, len(files) / elapsed), file=sys.stderr)
+    if latencies:
+        print('latency: p50 %.3fs, p95 %.3fs, max %.3fs' % (
+            latencies[len(latencies) // 2], latencies[len(latencies) * 95 // 100], latencies[-1]), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def _query_files(patterns):
+    """Yield the path and the name (relative to the directory given, if any) of the query files matching the
+    command line arguments"""
+    import glob
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for path in sorted(glob.glob(os.path.join(pattern, '**', '*.json'), recursive=True)):
+                yield path, os.path.relpath(path, pattern)
+            continue
+        # a path not matching any file is kept, to be reported as failed
+        for path in sorted(glob.glob(pattern, recursive=True)) or [pattern]:
+            yield path, os.path.basename(path)
+
+
+def _output_path(directory, name, extension):
+    path = os.path.join(directory, os.path.splitext(name)[0] + extension)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+if __name__ == '__main__':
+    import sys
+
+    sys.exit(main())
@@ -0,0 +1,641 @@
+"""Offline benchmarks of SPARQLTransformer, run with `python evaluation/benchmark.py` from the repository root.
+
+The SPARQL results in `examples/sparql_output` are scaled up by repeating their bindings, and the other queries
+(in `examples/json_queries` and `evaluation/sparql`) get synthetic results, so that no endpoint is needed.
+
+The `stages` and `synthetic` benchmarks can be compared with another revision of the module (`--compare REV`)
+and saved in JSON (`--json FILE`)."""
+import argparse
+import copy
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+import types
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+import SPARQLTransformer  # noqa: E402
+
+EXAMPLES = os.path.join(ROOT, 'examples')
+EVALUATION = os.path.join(ROOT, 'evaluation', 'sparql')
+
+
+def load_fixtures():
+    """Yield (name, json query, SPARQL results) for each example having a recorded endpoint output"""
+    for path in sorted(glob.glob(os.path.join(EXAMPLES, 'sparql_output', '*.json'))):
+        name = os.path.basename(path)
+        with open(os.path.join(EXAMPLES, 'json_queries', name)) as f:
+            query = json.load(f)
+        with open(path) as f:
+            res = json.load(f)
+        yield name, query, res
+
+
+def scale(bindings, rows):
+    """Repeat `bindings` up to `rows` lines"""
+    if not bindings:
+        return []
+    return (bindings * (rows // len(bindings) + 1))[:rows]
+
+
+def load_queries():
+    """Yield (name, json query, SPARQL results or None) for each query of the examples and of the evaluation"""
+    for path in sorted(glob.glob(os.path.join(EXAMPLES, 'json_queries', '*.json')) +
+                       glob.glob(os.path.join(EVALUATION, '*.json'))):
+        name = os.path.basename(path)
+        with open(path) as f:
+            query = json.load(f)
+        output = os.path.join(EXAMPLES, 'sparql_output', name)
+        res = None
+        if path.startswith(EXAMPLES) and os.path.exists(output):
+            with open(output) as f:
+                res = json.load(f)
+        yield name, query, res
+
+
+def generate(rows, anchors=1000, depth=1, fanout=5):
+    """Generate a query and its SPARQL results.
+
+    The results describe `anchors` root entities, each with `fanout` values of a multi-valued property and
+    `fanout` nested entities per level of nesting, down to `depth` levels."""
+    proto = {'id': '?id', 'name': '?name', 'tag': '?tag'}
+    parent = proto
+    for d in range(1, depth + 1):
+        parent['child'] = parent = {'id': '?c%d' % d, 'name': '?n%d' % d}
+
+    bindings = []
+    for r in range(rows):
+        entity, j = r % anchors, r // anchors
+        b = {'id': {'type': 'uri', 'value': 'http://example.org/%d' % entity},
+             'name': {'type': 'literal', 'value': 'Entity %d' % entity, 'xml:lang': 'en'},
+             'tag': {'type': 'literal', 'value': 'tag %d' % (j % fanout)}}
+        for d in range(1, depth + 1):
+            child = (j // fanout ** (d - 1)) % fanout
+            b['c%d' % d] = {'type': 'uri', 'value': 'http://example.org/%d/%d/%d' % (entity, d, child)}
+            b['n%d' % d] = {'type': 'literal', 'value': str(child * d),
+                            'datatype': 'http://www.w3.org/2001/XMLSchema#integer'}
+        bindings.append(b)
+    return {'proto': proto}, {'head': {'vars': list(bindings[0]) if bindings else []},
+                              'results': {'bindings': bindings}}
+
+
+def synthetic_results(query, proto, rows, anchors=1000, fanout=5):
+    """SPARQL results for the variables selected by the SPARQL `query`, with `anchors` distinct values of the
+    root anchor and `fanout` distinct values of the others for each anchor"""
+    head = query[:query.index('WHERE')]
+    variables = list(dict.fromkeys(re.findall(r'\?(\w+)', head)))
+    anchor = SPARQLTransformer._root_anchor_variable(proto)
+    bindings = []
+    for r in range(rows):
+        entity, j = r % anchors, r // anchors
+        b = {v: {'type': 'literal', 'value': '%s %d %d' % (v, entity, j % fanout)} for v in variables}
+        if anchor in b:
+            b[anchor] = {'type': 'uri', 'value': 'http://example.org/%d' % entity}
+        bindings.append(b)
+    return {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+
+
+def load_revision(rev):
+    """Load the SPARQLTransformer module of a git revision"""
+    source = subprocess.check_output(['git', 'show', '%s:SPARQLTransformer.py' % rev], cwd=ROOT)
+    module = types.ModuleType('SPARQLTransformer_' + re.sub(r'\W', '_', rev))
+    module.__file__ = os.path.join(ROOT, 'SPARQLTransformer.py')
+    sys.modules[module.__name__] = module
+    exec(compile(source, '%s:SPARQLTransformer.py' % rev, 'exec'), module.__dict__)
+    return module
+
+
+def peak_memory(fun):
+    """Peak of the memory allocated while running `fun`, in bytes"""
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def timeit(fun, repeat=3):
+    """Best wall time of `repeat` runs"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_proto(args):
+    """Per-row throughput of the prototype application: deep copy of the prototype (`_sparql2proto`)
+    against the compiled plan (`_compile_proto`)"""
+    rows, repeat = args.rows, args.repeat
+    print('%-32s %12s %12s %8s' % ('proto application', 'copy rows/s', 'plan rows/s', 'speedup'))
+    for name, query, res in load_fixtures():
+        _, proto, opt = SPARQLTransformer.pre_process(query)
+        bindings = scale(res['results']['bindings'], rows)
+
+        def before():
+            for b in bindings:
+                SPARQLTransformer._sparql2proto(b, proto, opt)
+
+        def after():
+            build = SPARQLTransformer._compile_proto(proto, opt)
+            for b in bindings:
+                build(b)
+
+        t_before = timeit(before, repeat)
+        t_after = timeit(after, repeat)
+        print('%-32s %12d %12d %7.1fx' % (name, rows / t_before, rows / t_after, t_before / t_after))
+
+
+def to_tsv(res):
+    """Serialize SPARQL JSON results in TSV, as an endpoint would do"""
+
+    def term(cell):
+        if cell['type'] == 'uri':
+            return '<%s>' % cell['value']
+        if cell['type'] == 'bnode':
+            return '_:' + cell['value']
+        value = cell['value'].replace('\\', '\\\\').replace('"', '\\"')
+        value = value.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        if 'xml:lang' in cell:
+            return '"%s"@%s' % (value, cell['xml:lang'])
+        if cell.get('datatype') == SPARQLTransformer.xsd('integer'):
+            return value
+        if 'datatype' in cell:
+            return '"%s"^^<%s>' % (value, cell['datatype'])
+        return '"%s"' % value
+
+    variables = res['head']['vars']
+    lines = ['\t'.join('?' + v for v in variables)]
+    for b in res['results']['bindings']:
+        lines.append('\t'.join(term(b[v]) if v in b else '' for v in variables))
+    return '\n'.join(lines) + '\n'
+
+
+def bench_tsv(args):
+    """Transfer size and decoding time of the results in JSON (`json.loads`) and in TSV (`_parse_tsv`),
+    and time of the whole `post_process` from the undecoded response"""
+    rows, repeat = args.rows, args.repeat
+    print('%-32s %9s %9s %10s %10s %10s %10s' % ('results format', 'JSON KB', 'TSV KB', 'JSON dec', 'TSV dec',
+                                                  'JSON post', 'TSV post'))
+    for name, query, res in load_fixtures():
+        _, proto, opt = SPARQLTransformer.pre_process(query)
+        res = dict(res, results={'bindings': scale(res['results']['bindings'], rows)})
+        json_body = json.dumps(res).encode('utf-8')
+        tsv_body = to_tsv(res).encode('utf-8')
+
+        t_json = timeit(lambda: json.loads(json_body), repeat)
+        t_tsv = timeit(lambda: SPARQLTransformer._parse_tsv(tsv_body), repeat)
+        t_json_post = timeit(lambda: SPARQLTransformer.post_process(json.loads(json_body), proto, opt), repeat)
+        t_tsv_post = timeit(lambda: SPARQLTransformer.post_process(tsv_body, proto, opt), repeat)
+        print('%-32s %9d %9d %9.3fs %9.3fs %9.3fs %9.3fs' % (name, len(json_body) / 1024, len(tsv_body) / 1024,
+                                                             t_json, t_tsv, t_json_post, t_tsv_post))
+
+
+def bench_columnar(args):
+    """`post_process` of a wide numeric result (population, capacity, dates...) per row and in columnar mode"""
+    rows, repeat = args.rows, args.repeat
+    xsd = SPARQLTransformer.xsd
+    columns = [('population', 'integer'), ('capacity', 'int'), ('area', 'double'), ('elevation', 'decimal'),
+               ('density', 'float'), ('founded', 'date'), ('capital', 'boolean'), ('rank', 'nonNegativeInteger')]
+    query = {'proto': dict([('id', '?id')] + [(name, '?' + name) for name, _ in columns])}
+    bindings = [dict([('id', {'type': 'uri', 'value': 'http://example.org/city/%d' % i})] +
+                     [(name, {'type': 'literal', 'datatype': xsd(datatype),
+                              'value': ('%04d-01-01' % (i % 2000) if datatype == 'date' else
+                                        'true' if datatype == 'boolean' else
+                                        '%d.%d' % (i, i % 7) if datatype in ['double', 'decimal', 'float'] else
+                                        str(i * 37))})
+                      for name, datatype in columns])
+                for i in range(rows)]
+    _, proto, opt = SPARQLTransformer.pre_process(query)
+    res = {'results': {'bindings': bindings}}
+
+    tsv = to_tsv(dict(res, head={'vars': list(bindings[0])}))
+
+    def run(results, columnar):
+        return lambda: SPARQLTransformer.post_process(results, proto, dict(opt, columnar=columnar))
+
+    print('%-32s %12s %12s %8s' % ('wide numeric result', 'rows/s', 'columnar/s', 'speedup'))
+    for fmt, results in [('JSON', res), ('TSV', tsv)]:
+        t_rows = timeit(run(results, False), repeat)
+        t_columns = timeit(run(results, True), repeat)
+        print('%-32s %12d %12d %7.1fx' % ('%d columns, %s' % (len(columns) + 1, fmt), rows / t_rows,
+                                          rows / t_columns, t_rows / t_columns))
+
+
+def bench_memo(args):
+    """`post_process` of a result repeating few terms (countries with their labels, population and area),
+    with and without the memo of the converted terms: time, peak memory and memory kept by the output"""
+    rows, repeat = args.rows, args.repeat
+    xsd = SPARQLTransformer.xsd
+    query = {'proto': {'id': '?id', 'country': '?country', 'label': '?label', 'population': '?population',
+                       'area': '?area'}}
+    bindings = [{'id': {'type': 'uri', 'value': 'http://example.org/city/%d' % i},
+                 'country': {'type': 'uri', 'value': 'http://example.org/country/%d' % (i % 50)},
+                 'label': {'type': 'literal', 'value': 'Country %d' % (i % 50), 'xml:lang': 'en'},
+                 'population': {'type': 'literal', 'value': str(i % 50 * 100000), 'datatype': xsd('integer')},
+                 'area': {'type': 'literal', 'value': '%d.5' % (i % 50), 'datatype': xsd('double')}}
+                for i in range(rows)]
+    _, proto, opt = SPARQLTransformer.pre_process(query)
+    res = {'results': {'bindings': bindings}}
+
+    def run():
+        return SPARQLTransformer.post_process(res, proto, opt)
+
+    def memory():
+        tracemalloc.start()
+        out = run()
+        kept, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del out
+        return kept, peak
+
+    memo_size = SPARQLTransformer.TERM_MEMO_SIZE
+    measures = []
+    for size in [0, memo_size]:
+        SPARQLTransformer.TERM_MEMO_SIZE = size
+        try:
+            measures.append((timeit(run, repeat),) + memory())
+        finally:
+            SPARQLTransformer.TERM_MEMO_SIZE = memo_size
+
+    print('%-32s %10s %10s %10s' % ('repeated terms', 'time', 'peak MB', 'output MB'))
+    for name, (t, kept, peak) in zip(['without memo', 'with memo'], measures):
+        print('%-32s %9.3fs %10.1f %10.1f' % (name, t, peak / 2 ** 20, kept / 2 ** 20))
+
+
+def bench_merge(args):
+    """`post_process` of a single entity with a multi-valued property, as many values as lines"""
+    rows, repeat = args.rows, args.repeat
+    query = {'proto': {'id': '?id', 'name': '?name', 'member': {'id': '?member', 'name': '?member_name'}}}
+    _, proto, opt = SPARQLTransformer.pre_process(query)
+    print('%-32s %12s %12s' % ('multi-valued property', 'time', 'values/s'))
+    for size in [rows // 100, rows // 10, rows]:
+        bindings = [{'id': {'type': 'uri', 'value': 'http://example.org/band'},
+                     'name': {'type': 'literal', 'value': 'name %d' % i, 'xml:lang': 'en'},
+                     'member': {'type': 'uri', 'value': 'http://example.org/member/%d' % (i % 7)},
+                     'member_name': {'type': 'literal', 'value': 'member %d' % (i % 5)}}
+                    for i in range(size)]
+        res = {'results': {'bindings': bindings}}
+        t = timeit(lambda: SPARQLTransformer.post_process(res, proto, opt), repeat)
+        print('%-32s %11.3fs %12d' % ('%d values' % size, t, size / t))
+
+
+def bench_prepare(args):
+    """SPARQL query of each call: `pre_process` of the JSON query with its `$values` against `bind` of a prepared
+    query"""
+    calls, repeat = 10000, args.repeat
+    print('%-32s %12s %12s %8s' % ('query with a parameter', 'pre_process/s', 'bind/s', 'speedup'))
+    for name, query, res in load_fixtures():
+        if '$values' not in query:
+            continue
+        variable = next(iter(query['$values']))
+        value = query['$values'][variable]
+        prepared = SPARQLTransformer.prepare(dict(query, **{'$values': {variable: '{{value}}'}}))
+        t_pre_process = timeit(lambda: [SPARQLTransformer.pre_process(query) for _ in range(calls)], repeat)
+        t_bind = timeit(lambda: [prepared.bind({'value': value}) for _ in range(calls)], repeat)
+        print('%-32s %12d %12d %7.1fx' % (name, calls / t_pre_process, calls / t_bind, t_pre_process / t_bind))
+
+
+def bench_graph(args):
+    """`post_process` of the results of a query on a local rdflib graph: read directly (`graph` option) against
+    converted to SPARQL JSON results by a `sparqlFunction` (serialized and parsed, or built as dicts)"""
+    import rdflib
+
+    rows, repeat = args.rows // 10, args.repeat
+    ex, xsd = rdflib.Namespace('http://example.org/'), rdflib.XSD
+    graph = rdflib.Graph()
+    for i in range(rows // 2):
+        entity = ex['entity/%d' % i]
+        graph.add((entity, rdflib.RDF.type, ex.Entity))
+        graph.add((entity, rdflib.RDFS.label, rdflib.Literal('Entity %d' % i, lang='en')))
+        graph.add((entity, ex.rank, rdflib.Literal(i)))
+        graph.add((entity, ex.score, rdflib.Literal(i / 7, datatype=xsd.double)))
+        graph.add((entity, ex.date, rdflib.Literal('2020-01-%02d' % (i % 28 + 1), datatype=xsd.date)))
+        for j in range(2):
+            graph.add((entity, ex.tag, rdflib.Literal('tag %d' % ((i + j) % 50))))
+    query = {'proto': {'id': '?id', 'name': '$rdfs:label', 'rank': '$ex:rank', 'score': '$ex:score',
+                       'date': '$ex:date', 'tag': '$ex:tag'},
+             '$where': '?id a ex:Entity', '$prefixes': {'ex': str(ex)}}
+    query_string, proto, opt = SPARQLTransformer.pre_process(query)
+    res = SPARQLTransformer._graph_sparql(graph)(query_string)
+    variables = [str(v) for v in res.vars]
+
+    def serialized():
+        return json.loads(res.serialize(format='json'))
+
+    def dicts():
+        bindings = []
+        for row in res:
+            b = {}
+            for v, term in zip(variables, row):
+                if term is None:
+                    continue
+                cell = {'type': 'literal', 'value': str(term)}
+                if getattr(term, 'datatype', None) is not None:
+                    cell['datatype'] = str(term.datatype)
+                if getattr(term, 'language', None) is not None:
+                    cell['xml:lang'] = term.language
+                b[v] = cell
+            bindings.append(b)
+        return {'head': {'vars': variables}, 'results': {'bindings': bindings}}
+
+    t_query = timeit(lambda: SPARQLTransformer._graph_sparql(graph)(query_string), 1)
+    print('%-32s %12s %12s' % ('%d rows (query: %.3fs)' % (len(res), t_query), 'time', 'rows/s'))
+    for name, fun in [('JSON serialized', lambda: SPARQLTransformer.post_process(serialized(), proto, opt)),
+                      ('JSON dicts', lambda: SPARQLTransformer.post_process(dicts(), proto, opt)),
+                      ('graph', lambda: SPARQLTransformer.post_process(res, proto, opt))]:
+        t = timeit(fun, repeat)
+        print('%-32s %11.3fs %12d' % (name, t, len(res) / t))
+
+
+def bench_dump(args):
+    """Export of the output in a file: `json.dump` of the output of `sparqlTransformer` against
+    `dump_sparqlTransformer`, with orjson (if installed) and with the standard library"""
+    import unittest.mock
+
+    rows, repeat = args.rows * 4, args.repeat
+    query, res = generate(rows, max(args.anchors, rows // 20), args.depth, args.fanout)
+    options = {'sparqlFunction': lambda q: res, 'ordered': True}  # the results are not ordered, but grouped
+
+    def json_dump():
+        with open(os.devnull, 'w') as out:
+            json.dump(SPARQLTransformer.sparqlTransformer(query, options), out)
+
+    def dump(orjson):
+        def run():
+            with unittest.mock.patch.dict(sys.modules, {} if orjson else {'orjson': None}), \
+                    open(os.devnull, 'wb') as out:
+                SPARQLTransformer.dump_sparqlTransformer(query, out, options, ndjson=True)
+        return run
+
+    res['results']['bindings'].sort(key=lambda b: b['id']['value'])
+    print('%-32s %12s %12s' % ('%d rows' % rows, 'time', 'peak MB'))
+    for name, fun in [('json.dump', json_dump), ('dump_sparqlTransformer', dump(True)),
+                      ('dump_sparqlTransformer, json', dump(False))]:
+        t = timeit(fun, repeat)
+        print('%-32s %11.3fs %12.1f' % (name, t, peak_memory(fun) / 2 ** 20))
+
+
+def bench_split(args):
+    """Results transferred and time of a query with several multi-valued properties on a local rdflib graph,
+    as a single query and with `splitQuery`"""
+    import rdflib
+
+    bands, repeat = max(1, args.anchors // 200), args.repeat
+    ex = rdflib.Namespace('http://example.org/')
+    graph = rdflib.Graph()
+    for i in range(bands):
+        band = ex['band/%d' % i]
+        graph.add((band, rdflib.RDF.type, ex.Band))
+        graph.add((band, rdflib.RDFS.label, rdflib.Literal('Band %d' % i)))
+        for prop, count in [('member', 10), ('genre', 20), ('album', 30)]:
+            for j in range(count):
+                graph.add((band, ex[prop], ex['%s/%d/%d' % (prop, i, j)]))
+    query = {'proto': {'id': '?id', 'name': '$rdfs:label$required', 'member': '$ex:member$list',
+                       'genre': '$ex:genre$list', 'album': {'id': '$ex:album', 'band': '?id'}},
+             '$where': '?id a ex:Band', '$prefixes': {'ex': str(ex)}}
+
+    def run(options, rows):
+        def sparql_function(q):
+            res = graph.query(q)
+            rows.append(len(res))
+            return res
+        options = dict(options, sparqlFunction=sparql_function, valuesConcurrency=1)
+        return lambda: SPARQLTransformer.sparqlTransformer(query, options)
+
+    print('%-32s %12s %12s' % ('%d bands' % bands, 'rows', 'time'))
+    for name, options in [('single query', {}), ('splitQuery', {'splitQuery': True})]:
+        rows = []
+        run(options, rows)()
+        t = timeit(run(options, []), repeat)
+        print('%-32s %12d %11.3fs' % (name, sum(rows), t))
+
+
+def bench_endpoints(args):
+    """Latency percentiles of queries to local stub endpoints stalling 5% of the requests for 0.5s, with one
+    endpoint, two endpoints in round-robin and two endpoints with `hedgePercentile`"""
+    import random
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    name, query, res = next(load_fixtures())
+    body = json.dumps(res).encode('utf-8')
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if random.random() < 0.05:
+                time.sleep(0.5)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/sparql-results+json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), Handler) for _ in range(2)]
+    for server in servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoints = ['http://127.0.0.1:%d/sparql' % server.server_address[1] for server in servers]
+
+    print('%-32s %12s %12s %12s' % ('%d queries' % (args.repeat * 100), 'p50', 'p99', 'max'))
+    for label, options in [('one endpoint', {'endpoint': endpoints[0]}),
+                           ('round-robin', {'endpoint': endpoints}),
+                           ('hedgePercentile 90', {'endpoint': endpoints, 'hedgePercentile': 90})]:
+        random.seed(0)
+        latencies = []
+        for _ in range(args.repeat * 100):
+            start = time.perf_counter()
+            SPARQLTransformer.sparqlTransformer(query, options)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        print('%-32s %10.1fms %10.1fms %10.1fms' % (label, latencies[len(latencies) // 2] * 1000,
+                                                    latencies[len(latencies) * 99 // 100] * 1000, latencies[-1] * 1000))
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_parallel(args):
+    """`post_process` of a large synthetic result in this process and in worker processes (`processes` option)"""
+    rows, repeat = args.rows * 4, args.repeat
+    query, res = generate(rows, max(args.anchors, rows // 20), args.depth, args.fanout)
+    _, proto, opt = SPARQLTransformer.pre_process(query)
+    tsv = to_tsv(res)
+    cpus = os.cpu_count() or 1
+
+    def run(results, processes):
+        return lambda: SPARQLTransformer.post_process(results, proto, dict(opt, processes=processes,
+                                                                           parallelThreshold=0))
+
+    print('%-32s %12s %12s %8s' % ('%d rows, %d CPUs' % (rows, cpus), 'serial', 'parallel', 'speedup'))
+    for fmt, results in [('JSON', res), ('TSV', tsv)]:
+        t_serial = timeit(run(results, None), repeat)
+        for processes in sorted({2, max(cpus, 2)}):
+            t_parallel = timeit(run(results, processes), repeat)
+            print('%-32s %11.3fs %11.3fs %7.1fx' % ('%s, %d processes' % (fmt, processes), t_serial, t_parallel,
+                                                    t_serial / t_parallel))
+
+
+def measure_stages(module, args):
+    """Time `pre_process`, `_jsonld2query` and `post_process` of `module` for each query"""
+    records = []
+    calls = 1000
+    for name, query, res in load_queries():
+        query_string, proto, opt = SPARQLTransformer.pre_process(query)
+        if res is None:
+            res = synthetic_results(query_string, proto, args.rows, args.anchors, args.fanout)
+        else:
+            res = dict(res, results={'bindings': scale(res['results']['bindings'], args.rows)})
+        rows = len(res['results']['bindings'])
+        _, proto, opt = module.pre_process(query)
+
+        def pre_process():
+            for _ in range(calls):
+                module.pre_process(query)
+
+        def jsonld2query():
+            for q in queries:
+                module._jsonld2query(q)
+
+        queries = []
+
+        def copies():  # _jsonld2query consumes its input
+            queries[:] = [copy.deepcopy(query) for _ in range(calls)]
+
+        def post_process():
+            module.post_process(res, proto, opt)
+
+        module.post_process(res, proto, opt)  # warm up
+        t_jsonld2query = float('inf')
+        for _ in range(args.repeat):
+            copies()
+            t_jsonld2query = min(t_jsonld2query, timeit(jsonld2query, 1))
+        t_pre_process = timeit(pre_process, args.repeat)
+        t_post_process = timeit(post_process, args.repeat)
+        records += [
+            {'query': name, 'stage': 'pre_process', 'seconds': t_pre_process / calls,
+             'throughput': calls / t_pre_process, 'unit': 'calls/s'},
+            {'query': name, 'stage': '_jsonld2query', 'seconds': t_jsonld2query / calls,
+             'throughput': calls / t_jsonld2query, 'unit': 'calls/s'},
+            {'query': name, 'stage': 'post_process', 'seconds': t_post_process, 'rows': rows,
+             'throughput': rows / t_post_process, 'unit': 'rows/s', 'peak_mb': peak_memory(post_process) / 2 ** 20},
+        ]
+    return records
+
+
+def measure_synthetic(module, args):
+    """Time `post_process` of `module` on the generated results, for each nesting depth up to `args.depth`"""
+    records = []
+    for depth in range(args.depth + 1):
+        query, res = generate(args.rows, args.anchors, depth, args.fanout)
+        _, proto, opt = module.pre_process(query)
+
+        def post_process():
+            module.post_process(res, proto, opt)
+
+        t = timeit(post_process, args.repeat)
+        records.append({'query': 'depth %d, fan-out %d, %d anchors' % (depth, args.fanout, args.anchors),
+                        'stage': 'post_process', 'seconds': t, 'rows': args.rows, 'throughput': args.rows / t,
+                        'unit': 'rows/s', 'peak_mb': peak_memory(post_process) / 2 ** 20})
+    return records
+
+
+def report(title, measure, args):
+    """Print the records of `measure` for the current module and, with `--compare`, for another revision.
+
+    Return the records, with the compared ones under `baseline`."""
+    records = measure(SPARQLTransformer, args)
+    if args.compare:
+        for record, baseline in zip(records, measure(load_revision(args.compare), args)):
+            record['baseline'] = baseline
+            record['ratio'] = record['seconds'] / baseline['seconds']
+
+    print('%-40s %-14s %14s %10s' % (title, 'stage', 'throughput', 'peak MB') +
+          (' %14s %8s' % (args.compare, 'ratio') if args.compare else ''))
+    for r in records:
+        line = '%-40s %-14s %14s %10s' % (r['query'], r['stage'], '%d %s' % (r['throughput'], r['unit']),
+                                         '%.1f' % r['peak_mb'] if 'peak_mb' in r else '')
+        if args.compare:
+            line += ' %14s %7.2fx' % ('%d %s' % (r['baseline']['throughput'], r['unit']), r['ratio'])
+            if r['ratio'] > args.threshold:
+                line += '  REGRESSION'
+        print(line)
+    for r in records:
+        r['benchmark'] = title
+    return records
+
+
+def bench_stages(args):
+    """Time of each stage (query generation and results transformation) for the example and evaluation queries"""
+    return report('stages', measure_stages, args)
+
+
+def bench_synthetic(args):
+    """`post_process` of generated results, with configurable anchors, nesting depth and fan-out"""
+    return report('synthetic', measure_synthetic, args)
+
+
+BENCHMARKS = {
+    'proto': bench_proto,
+    'tsv': bench_tsv,
+    'columnar': bench_columnar,
+    'memo': bench_memo,
+    'merge': bench_merge,
+    'prepare': bench_prepare,
+    'graph': bench_graph,
+    'dump': bench_dump,
+    'split': bench_split,
+    'endpoints': bench_endpoints,
+    'parallel': bench_parallel,
+    'stages': bench_stages,
+    'synthetic': bench_synthetic,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='benchmarks to run among %s (default: all)' % ', '.join(BENCHMARKS))
+    parser.add_argument('--rows', type=int, default=50000, help='number of bindings of each scaled result')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions, the best time is kept')
+    parser.add_argument('--anchors', type=int, default=1000, help='distinct root entities in synthetic results')
+    parser.add_argument('--depth', type=int, default=2, help='maximum nesting depth of synthetic results')
+    parser.add_argument('--fanout', type=int, default=5,
+                        help='distinct values of each multi-valued property of synthetic results')
+    parser.add_argument('--compare', metavar='REV', help='git revision to compare the stages and synthetic '
+                                                         'benchmarks with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown against the compared revision reported as a regression (exit status 1)')
+    parser.add_argument('--json', metavar='FILE', help='write the stages and synthetic measures in FILE')
+    args = parser.parse_args()
+    for b in args.benchmarks:
+        if b not in BENCHMARKS:
+            parser.error('unknown benchmark %s' % b)
+
+    records = []
+    for b in args.benchmarks or BENCHMARKS:
+        records += BENCHMARKS[b](args) or []
+        print()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=2)
+    if any(r.get('ratio', 0) > args.threshold for r in records):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
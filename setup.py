@@ -13,6 +13,7 @@ with open(path.join(this_directory, 'README.md'), encoding='utf-8') as f:
 setup(name="SPARQLTransformer",
       version="2.4.0",
       install_requires=requirements,
+      extras_require={'async': ['aiohttp']},
       data_files=[('txt', ['requirements.txt'])],
       py_modules=["SPARQLTransformer"],
 
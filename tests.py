@@ -1,9 +1,28 @@
+import io
 import os
+import re
+import tempfile
 import json
+import logging
 import string
+import subprocess
+import sys
+import gzip
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.parse import urlsplit, parse_qs
+import asyncio
 import unittest
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 from simplejson import dumps
+try:
+    import rdflib
+except ImportError:
+    rdflib = None
 from SPARQLTransformer import sparqlTransformer, pre_process
 import SPARQLTransformer
 
@@ -21,13 +40,8 @@ def mock(filename):
     with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
         obj = json.load(data)
 
-    def f(self):
-        class x:
-            @staticmethod
-            def convert():
-                return obj
-
-        return x
+    def f(self, query):
+        return obj
 
     return f
 
@@ -53,7 +67,7 @@ def cleans(s):
 
 
 class TestStringMethods(unittest.TestCase):
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('city.list.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('city.list.json'))
     def test_proto(self):
         q, expected, rq = load('city.list.json')
 
@@ -66,7 +80,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('city.list.ld.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('city.list.ld.json'))
     def test_jsonld(self):
         q, expected, rq = load('city.list.ld.json')
         outSparql = get_sparql_query(q)
@@ -78,7 +92,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('city.region.list.ld.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('city.region.list.ld.json'))
     def test_nested(self):
         q, expected, rq = load('city.region.list.ld.json')
         outSparql = get_sparql_query(q)
@@ -90,7 +104,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('band.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('band.json'))
     def test_anchor(self):
         q, expected, rq = load('band.json')
         outSparql = get_sparql_query(q)
@@ -102,7 +116,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('band_reversed.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('band_reversed.json'))
     def test_reversed(self):
         q, expected, rq = load('band_reversed.json')
         outSparql = get_sparql_query(q)
@@ -114,7 +128,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('issue_10_duplicate_vars.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('issue_10_duplicate_vars.json'))
     def test_reversed(self):
         q, expected, rq = load('issue_10_duplicate_vars.json')
         outSparql = get_sparql_query(q)
@@ -126,7 +140,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('aggregates.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('aggregates.json'))
     def test_aggregates(self):
         q, expected, rq = load('aggregates.json')
         outSparql = get_sparql_query(q)
@@ -138,7 +152,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('band_forcelist.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('band_forcelist.json'))
     def test_forcelist(self):
         q, expected, rq = load('band_forcelist.json')
         outSparql = get_sparql_query(q)
@@ -150,7 +164,7 @@ class TestStringMethods(unittest.TestCase):
 
         self.assertEqual(dumps(out), dumps(expected))
 
-    @patch.object(SPARQLTransformer.SPARQLWrapper, 'query', mock('band.liblimit.json'))
+    @patch.object(SPARQLTransformer._EndpointClient, 'query', mock('band.liblimit.json'))
     def test_library_limit(self):
         q, expected, rq = load('band.liblimit.json')
         outSparql = get_sparql_query(q)
@@ -163,5 +177,1191 @@ class TestStringMethods(unittest.TestCase):
         self.assertEqual(dumps(out), dumps(expected))
 
 
+def uri(value):
+    return {'type': 'uri', 'value': value}
+
+
+def literal(value, lang=None):
+    cell = {'type': 'literal', 'value': value}
+    if lang:
+        cell['xml:lang'] = lang
+    return cell
+
+
+XSD = 'http://www.w3.org/2001/XMLSchema#'
+
+
+def results(bindings):
+    return {'head': {'vars': []}, 'results': {'bindings': bindings}}
+
+
+MEMBERS_QUERY = {
+    'proto': {
+        'id': '?id',
+        'member': {
+            'id': '$dbo:bandMember$anchor',
+            'name': '$foaf:name'
+        }
+    },
+    '$where': '?id a dbo:Band'
+}
+
+MEMBERS_BINDINGS = [
+    {'id': uri('b1'), 'v1r': uri('m1'), 'v11': literal('Kurt')},
+    {'id': uri('b2'), 'v1r': uri('m1'), 'v11': literal('Kurt')},
+    {'id': uri('b1'), 'v1r': uri('m2'), 'v11': literal('Krist')},
+    {'id': uri('b1'), 'v1r': uri('m1'), 'v11': literal('Kurt Cobain')},
+    {'id': uri('b1'), 'v1r': uri('m2'), 'v11': literal('Krist', 'en')},
+]
+
+MEMBERS_EXPECTED = [
+    {'id': 'b1', 'member': [
+        {'id': 'm1', 'name': ['Kurt', 'Kurt Cobain']},
+        {'id': 'm2', 'name': ['Krist', {'language': 'en', 'value': 'Krist'}]}
+    ]},
+    {'id': 'b2', 'member': {'id': 'm1', 'name': 'Kurt'}}
+]
+
+
+class TestMerge(unittest.TestCase):
+    def test_nested_anchor(self):
+        out = sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: results(MEMBERS_BINDINGS)})
+        self.assertEqual(dumps(out), dumps(MEMBERS_EXPECTED))
+
+    def test_unhashable_anchor(self):
+        q = {'proto': {'label': '?label$anchor', 'id': '?id'}}
+        bindings = [{'label': literal('Rome', 'en'), 'id': uri('r1')},
+                    {'label': literal('Rome', 'en'), 'id': uri('r2')},
+                    {'label': literal('Roma', 'it'), 'id': uri('r3')}]
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: results(bindings)})
+        self.assertEqual(out, [{'label': {'language': 'en', 'value': 'Rome'}, 'id': ['r1', 'r2']},
+                               {'label': {'language': 'it', 'value': 'Roma'}, 'id': 'r3'}])
+
+    def test_fingerprints(self):
+        nan = float('nan')
+        self.assertEqual(SPARQLTransformer._fingerprint({'a': 1, 'b': [nan, {'c': 'd'}]}),
+                         SPARQLTransformer._fingerprint({'b': [float('nan'), {'c': 'd'}], 'a': 1}))
+        self.assertNotEqual(SPARQLTransformer._fingerprint([1, 2]), SPARQLTransformer._fingerprint([2, 1]))
+
+        base = {'id': 'x', 'v': [nan, {'language': 'en', 'value': 'a'}]}
+        SPARQLTransformer._merge_obj(base, {'id': 'x', 'v': float('nan')})
+        SPARQLTransformer._merge_obj(base, {'id': 'x', 'v': {'value': 'a', 'language': 'en'}})
+        SPARQLTransformer._merge_obj(base, {'id': 'x', 'v': 'b'})
+        self.assertEqual(len(base['v']), 3)
+
+    def test_many_values(self):
+        q = {'proto': {'id': '?id', 'name': '?name', 'member': {'id': '?m', 'name': '?mname'}}}
+        bindings = [{'id': uri('b1'), 'name': literal('n%d' % (i % 3000)), 'm': uri('m%d' % (i % 7)),
+                     'mname': literal('m%d' % (i % 5), 'en')} for i in range(6000)]
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: results(bindings)})
+        self.assertEqual(len(out), 1)
+        self.assertEqual(out[0]['name'], ['n%d' % i for i in range(3000)])
+        self.assertEqual([m['id'] for m in out[0]['member']], ['m%d' % i for i in range(7)])
+        self.assertEqual(len(out[0]['member'][0]['name']), 5)
+
+
+IMPORT_BUDGET = 0.5  # seconds, generous to be stable on slow machines
+IMPORT_SCRIPT = '''
+import json, logging, sys, time
+start = time.perf_counter()
+import SPARQLTransformer
+elapsed = time.perf_counter() - start
+print(json.dumps([elapsed, sorted(sys.modules), len(logging.root.handlers)]))
+'''
+
+
+class TestImport(unittest.TestCase):
+    def test_import_time(self):
+        """Importing the module is fast: the modules for the endpoint, the cache and asyncio are loaded
+        only when used, and logging is not configured"""
+        runs = [json.loads(subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                                   cwd=os.path.dirname(os.path.abspath(__file__))))
+                for _ in range(3)]
+        elapsed, modules, handlers = min(runs)
+        self.assertLess(elapsed, IMPORT_BUDGET)
+        lazy = {'asyncio', 'concurrent.futures', 'email', 'gzip', 'hashlib', 'http.client', 'pprint', 'sqlite3', 'ssl',
+                'urllib.request', 'SPARQLWrapper', 'simplejson', 'rdflib'}
+        self.assertEqual(lazy & set(modules), set())
+        self.assertEqual(handlers, 0)
+
+
+class TestThreads(unittest.TestCase):
+    def test_concurrent_transformations(self):
+        """Transformations running in many threads (also on free-threaded builds) give the same results
+        of serial ones, and the debug option of a call does not affect the others"""
+        jobs = []
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+            for options in [{}, {'debug': True}, {'cache': True}, {'columnar': True}]:
+                jobs.append((q, dict(options, sparqlFunction=lambda q, res=res: res)))
+
+        def run(job):
+            return dumps(sparqlTransformer(*job))
+
+        with self.assertLogs('sparql_transformer.debug', level='DEBUG') as logs:
+            serial = list(map(run, jobs))
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                for _ in range(5):
+                    self.assertEqual(list(executor.map(run, jobs * 4)), serial * 4)
+        self.assertEqual(len([r for r in logs.records if r.levelno == logging.INFO]), len(jobs) // 4 * 21)
+        self.assertEqual(SPARQLTransformer.logger.level, logging.NOTSET)
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        q, expected, rq = load('band.json')
+        collected = []
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: res, 'onStats': collected.append})
+        self.assertEqual(dumps(out), dumps(expected))
+
+        stats, = collected
+        self.assertEqual(set(stats), set(SPARQLTransformer.STATS_STAGES + SPARQLTransformer.STATS_COUNTERS))
+        self.assertTrue(all(stats[stage] >= 0 for stage in SPARQLTransformer.STATS_STAGES))
+        self.assertEqual(stats['bindings'], len(res['results']['bindings']))
+        self.assertEqual(stats['instances'], len(res['results']['bindings']))
+        self.assertEqual(stats['entities'], len(expected))
+        self.assertGreaterEqual(stats['merges'], stats['instances'] - stats['entities'])
+        self.assertGreater(stats['comparisons'], 0)
+
+    def test_batch_stats(self):
+        collected = []
+        options = {'sparqlFunction': lambda q: results(MEMBERS_BINDINGS), 'onStats': collected.append}
+        out = SPARQLTransformer.sparqlTransformer_batch([(MEMBERS_QUERY, options), (MEMBERS_QUERY, options)])
+        self.assertEqual(out, [MEMBERS_EXPECTED, MEMBERS_EXPECTED])
+        self.assertEqual([s['entities'] for s in collected], [2, 2])
+
+        collected.clear()
+        out = asyncio.run(SPARQLTransformer.sparqlTransformer_async(MEMBERS_QUERY, options))
+        self.assertEqual(out, MEMBERS_EXPECTED)
+        self.assertEqual(collected[0]['bindings'], len(MEMBERS_BINDINGS))
+
+
+def to_tsv(sparql_res):
+    """Serialize SPARQL JSON results in TSV"""
+
+    def term(cell):
+        if cell['type'] == 'uri':
+            return '<%s>' % cell['value']
+        if cell['type'] == 'bnode':
+            return '_:' + cell['value']
+        value = cell['value'].replace('\\', '\\\\').replace('"', '\\"')
+        value = value.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        if 'xml:lang' in cell:
+            return '"%s"@%s' % (value, cell['xml:lang'])
+        if 'datatype' in cell:
+            return '"%s"^^<%s>' % (value, cell['datatype'])
+        return '"%s"' % value
+
+    variables = sparql_res['head']['vars']
+    lines = ['\t'.join('?' + v for v in variables)]
+    for b in sparql_res['results']['bindings']:
+        lines.append('\t'.join(term(b[v]) if v in b else '' for v in variables))
+    return '\n'.join(lines) + '\n'
+
+
+class TestPrepare(unittest.TestCase):
+    def test_bind(self):
+        q, expected, rq = load('band.json')
+        template = dict(q, **{'$values': {'genre': '{{genre}}'}})
+        prepared = SPARQLTransformer.prepare(template)
+        self.assertEqual(prepared.parameters, {'genre'})
+        self.assertEqual(prepared.bind({'genre': 'dbr:Grunge'}), get_sparql_query(q))
+        self.assertEqual(template['$values'], {'genre': '{{genre}}'})
+
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        out = prepared({'genre': 'dbr:Grunge'}, {'sparqlFunction': lambda q: res})
+        self.assertEqual(dumps(out), dumps(expected))
+
+        with self.assertRaises(KeyError):
+            prepared.bind({})
+
+    def test_escape(self):
+        prepared = SPARQLTransformer.prepare({
+            'proto': {'id': '?id', 'name': '$rdfs:label'},
+            '$values': {'id': '{{id}}'},
+            '$filter': ['?name IN ({{names}})', 'lang(?name) = {{lang}}']
+        })
+        query = prepared.bind({'id': ['http://example.org/a> } ; DROP ALL #', 'dbr:Italy', 'x:y } #', 'Italia@it'],
+                               'names': ['"quoted"\\', 'new\nline'], 'lang': 'en'})
+        self.assertIn('VALUES ?id {<http://example.org/a%3E%20%7D%20;%20DROP%20ALL%20#> dbr:Italy "x:y } #" '
+                      '"Italia"@it}', query)
+        self.assertIn('FILTER(?name IN ("\\"quoted\\"\\\\", "new\\nline"))', query)
+        self.assertIn('FILTER(lang(?name) = "en")', query)
+
+    def test_call(self):
+        prepared = SPARQLTransformer.prepare(dict(MEMBERS_QUERY, **{'$values': {'id': '{{band}}'}}),
+                                             {'sparqlFunction': lambda q: results(MEMBERS_BINDINGS)})
+        queries = []
+        stats = []
+        out = prepared({'band': 'http://example.org/b1'},
+                       {'sparqlFunction': lambda q: queries.append(q) or results(MEMBERS_BINDINGS),
+                        'onStats': stats.append})
+        self.assertEqual(out, MEMBERS_EXPECTED)
+        self.assertIn('VALUES ?id {<http://example.org/b1>}', queries[0])
+        self.assertEqual(stats[0]['bindings'], len(MEMBERS_BINDINGS))
+        self.assertEqual(prepared({'band': 'x'}), MEMBERS_EXPECTED)
+        self.assertNotIn('onStats', prepared.opt)
+
+    def test_chunks(self):
+        template = dict(VALUES_QUERY, **{'$values': {'id': '{{ids}}'}})
+        expected = sparqlTransformer(VALUES_QUERY, {'sparqlFunction': values_endpoint([])})
+        queries = []
+        prepared = SPARQLTransformer.prepare(template, {'sparqlFunction': values_endpoint(queries),
+                                                        'valuesChunkSize': 10})
+        out = prepared({'ids': VALUES_QUERY['$values']['id']})
+        self.assertEqual(out, expected)
+        self.assertEqual(len(queries), 3)
+        prepared({'ids': VALUES_QUERY['$values']['id'][:10]})
+        self.assertEqual(len(queries), 4)
+
+    @unittest.skipIf(rdflib is None, 'rdflib is not installed')
+    def test_split(self):
+        g = band_graph()
+        ids = ['http://example.org/band/%d' % i for i in range(4)]
+        expected = sparqlTransformer(dict(WIDE_QUERY, **{'$values': {'id': ids}}), {'sparqlFunction': g.query})
+        queries = []
+        prepared = SPARQLTransformer.prepare(dict(WIDE_QUERY, **{'$values': {'id': '{{ids}}'}}),
+                                             {'sparqlFunction': lambda q: queries.append(q) or g.query(q),
+                                              'splitQuery': True})
+        self.assertEqual(dumps(prepared({'ids': ids})), dumps(expected))
+        self.assertEqual(len(queries), 4)
+
+
+class TestPlan(unittest.TestCase):
+    def test_compiled_proto(self):
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            _, proto, options = pre_process(q)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                bindings = json.load(data)['results']['bindings']
+            build = SPARQLTransformer._compile_proto(proto, options)
+            for b in bindings:
+                self.assertEqual(dumps(build(b)), dumps(SPARQLTransformer._sparql2proto(b, proto, options)))
+
+    def test_columnar(self):
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+            out = sparqlTransformer(q, {'sparqlFunction': lambda q: res, 'columnar': True})
+            self.assertEqual(dumps(out), dumps(expected))
+
+    def test_columnar_numbers(self):
+        def typed(value, datatype):
+            return {'type': 'literal', 'value': value, 'datatype': SPARQLTransformer.xsd(datatype)}
+
+        q = {'proto': {'id': '?id', 'population': '?p', 'area': '?a', 'capital': '?c$accept:bool'}}
+        bindings = [{'id': uri('x'), 'p': typed('12', 'integer'), 'a': typed('-INF', 'double'), 'c': typed('1', 'boolean')},
+                    {'id': uri('y'), 'p': typed('123456789012345678901234', 'integer'), 'a': typed('1.5', 'decimal')},
+                    {'id': uri('z'), 'p': literal('unknown'), 'c': typed('false', 'boolean')}]
+        expected = [{'id': 'x', 'population': 12, 'area': float('-inf'), 'capital': True},
+                    {'id': 'y', 'population': 123456789012345678901234, 'area': 1.5},
+                    {'id': 'z', 'population': 'unknown', 'capital': False}]
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: results(bindings), 'columnar': True})
+        self.assertEqual(out, expected)
+        self.assertEqual(out, sparqlTransformer(q, {'sparqlFunction': lambda q: results(bindings)}))
+
+    def test_repeated_terms(self):
+        q = {'proto': {'id': '?id', 'label': '?label', 'names': '?label$list', 'n': '?n$accept:number', 'ns': '?n$list'}}
+        n = {'type': 'literal', 'value': '7', 'datatype': SPARQLTransformer.xsd('int')}
+        bindings = [{'id': uri('x'), 'label': literal('Roma', 'it'), 'n': n},
+                    {'id': uri('y'), 'label': literal('Roma', 'it'), 'n': n}]
+        for options in [{}, {'columnar': True}]:
+            x, y = sparqlTransformer(q, dict(options, sparqlFunction=lambda q: results(bindings)))
+            self.assertEqual(x['label'], {'language': 'it', 'value': 'Roma'})
+            self.assertIs(x['label'], y['label'])
+            self.assertEqual(x['names'], x['label'])
+            self.assertEqual((x['n'], y['n']), (7, 7))
+            self.assertEqual(x['ns'], [7])
+            self.assertIsNot(x['ns'], y['ns'])
+
+    def test_list_in_proto(self):
+        q = {'proto': {'id': '?id', 'names': ['?a', '?b', 'constant'], 'unbound': ['?c']}}
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: results([{'id': uri('x'), 'a': literal('A')}])})
+        self.assertEqual(out, [{'id': 'x', 'names': ['A', None, 'constant']}])
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        SPARQLTransformer.pre_process_cache_clear()
+
+    def test_pre_process_cache(self):
+        q, expected, rq = load('band.json')
+        uncached = pre_process(q)
+
+        query, proto, options = pre_process(q, {'cache': True})
+        self.assertEqual((query, proto, options['voc']), (uncached[0], uncached[1], uncached[2]['voc']))
+        proto['band'] = 'modified'
+        options['voc'] = None
+
+        query, proto, options = pre_process(q, {'cache': True})
+        self.assertEqual((query, proto, options['voc']), (uncached[0], uncached[1], uncached[2]['voc']))
+        self.assertEqual(SPARQLTransformer.pre_process_cache_info()[:2], (1, 1))
+
+        pre_process(q, {'cache': True, 'langTag': 'hide'})
+        self.assertEqual(SPARQLTransformer.pre_process_cache_info()[:2], (1, 2))
+
+    def test_runtime_options(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        pre_process(q, {'cache': True, 'sparqlFunction': lambda q: None})
+        out = sparqlTransformer(q, {'cache': True, 'sparqlFunction': lambda q: res})
+        self.assertEqual(dumps(out), dumps(expected))
+        self.assertEqual(SPARQLTransformer.pre_process_cache_info().hits, 1)
+
+
+class TestPaging(unittest.TestCase):
+    def test_library_paging(self):
+        q, expected, rq = load('band.liblimit.json')
+        query, proto, options = pre_process(q, {'paging': True})
+        where = cleans(rq)[cleans(rq).index('WHERE{'):]
+        subquery = '{SELECTDISTINCT?id' + where + 'ORDERBY?idLIMIT10OFFSET5}'
+        self.assertTrue(cleans(query).endswith('WHERE{' + subquery + where[6:] + 'ORDERBY?id'))
+        self.assertNotIn('limit', options)
+
+        # the endpoint returns only the bindings of the selected bands
+        ids = [band['band'] for band in expected]
+        with open(os.path.join(SPARQL_OUTPUT, 'band.liblimit.json')) as data:
+            res = json.load(data)
+        res['results']['bindings'] = [b for b in res['results']['bindings'] if b['id']['value'] in ids]
+        out = sparqlTransformer(q, {'paging': True, 'sparqlFunction': lambda q: res})
+        self.assertEqual(dumps(out), dumps(expected))
+
+    def test_not_pageable(self):
+        q, expected, rq = load('band.liblimit.json')
+        q['$orderby'] = '?v1'
+        query, proto, options = pre_process(q, {'paging': True})
+        self.assertNotIn('LIMIT', query)
+        self.assertEqual((options['limit'], options['offset']), (10, 5))
+
+
+class TestTSV(unittest.TestCase):
+    def test_tsv(self):
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+            tsv = to_tsv(res)
+            out = sparqlTransformer(q, {'sparqlFunction': lambda q: tsv})
+            self.assertEqual(dumps(out), dumps(expected))
+
+    def test_terms(self):
+        tsv = '?a\t?b\t?c\n' \
+              '"tab\\there \\"quoted\\" \\u00e8"@it\t12\t-1.5E3\n' \
+              '\ttrue\t.5\n' \
+              '_:b0\t\t"2020-01-01"^^<http://www.w3.org/2001/XMLSchema#date>\n'
+        q = {'proto': {'a': '?a', 'b': '?b', 'c': '?c'}}
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: tsv})
+        self.assertEqual(out, [{'a': {'language': 'it', 'value': 'tab\there "quoted" \u00e8'}, 'b': 12, 'c': -1500.0},
+                               {'b': True, 'c': 0.5},
+                               {'a': 'b0', 'c': '2020-01-01'}])
+
+    def test_columnar(self):
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                tsv = to_tsv(json.load(data))
+            out = sparqlTransformer(q, {'sparqlFunction': lambda q: tsv, 'columnar': True})
+            self.assertEqual(dumps(out), dumps(expected))
+
+        double, text = '^^<%s>' % SPARQLTransformer.xsd('double'), '^^<%s>' % SPARQLTransformer.xsd('string')
+        tsv = '?id\t?n\t?d\t?e\n' \
+              '<x>\t-3\t"1.5"%s\t"a\\"b"%s\n' \
+              '<y>\t+7\t"INF"%s\t"c"%s\r\n' % (double, text, double, text)
+        q = {'proto': {'id': '?id', 'n': '?n', 'd': '?d', 'e': '?e'}}
+        out = sparqlTransformer(q, {'sparqlFunction': lambda q: tsv, 'columnar': True})
+        self.assertEqual(out, [{'id': 'x', 'n': -3, 'd': 1.5, 'e': 'a"b'}, {'id': 'y', 'n': 7, 'd': float('inf'), 'e': 'c'}])
+        self.assertEqual(out, sparqlTransformer(q, {'sparqlFunction': lambda q: tsv}))
+
+
+class TestParallel(unittest.TestCase):
+    def test_parallel(self):
+        parallel = {'processes': 2, 'parallelThreshold': 0}
+        for filename in sorted(os.listdir(SPARQL_OUTPUT)):
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+            for results in (res, to_tsv(res)):
+                out = sparqlTransformer(q, {'sparqlFunction': lambda q: results, **parallel})
+                self.assertEqual(dumps(out), dumps(expected))
+
+    def test_order(self):
+        res = results([{'id': uri('b%d' % (i * 3 % 7)), 'v1r': uri('m%d' % (i % 4)), 'v11': literal('name %d' % i)}
+                       for i in range(50)])
+        for extra in ({}, {'$limit': 3, '$offset': 2, '$limitMode': 'library'}):
+            q = dict(MEMBERS_QUERY, **extra)
+            serial = sparqlTransformer(q, {'sparqlFunction': lambda q: res})
+            with patch('concurrent.futures.ProcessPoolExecutor.submit',
+                       side_effect=concurrent.futures.ProcessPoolExecutor.submit, autospec=True) as submit:
+                out = sparqlTransformer(q, {'sparqlFunction': lambda q: res, 'processes': 3, 'parallelThreshold': 0})
+            self.assertEqual(submit.call_count, 3)
+            self.assertEqual(out, serial)
+
+    def test_fallback(self):
+        res = results([{'id': uri('b%d' % i), 'v1r': uri('m1'), 'v11': literal('Kurt')} for i in range(10)])
+        with patch('concurrent.futures.ProcessPoolExecutor') as executor:
+            out = sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: res, 'processes': 2})
+            self.assertEqual(len(out), 10)
+            sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: res, 'processes': 1, 'parallelThreshold': 0})
+        executor.assert_not_called()
+
+        parallel = {'processes': 2, 'parallelThreshold': 0}
+        with patch('concurrent.futures.ProcessPoolExecutor') as executor:
+            self.assertEqual(sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: results([]), **parallel}), [])
+            out = sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: results(res['results']['bindings'][:1]),
+                                                    **parallel})
+            self.assertEqual(len(out), 1)
+        executor.assert_not_called()
+
+    def test_process_state(self):
+        import multiprocessing
+        res = results([{'id': uri('b%d' % i), 'v1r': uri('m1'), 'v11': literal('Kurt')} for i in range(10)])
+        method = multiprocessing.get_start_method(allow_none=True)
+        stats = []
+        # the workers do not take the locks of the module, which can be held by other threads when forking
+        with SPARQLTransformer._stats_lock:
+            out = sparqlTransformer(MEMBERS_QUERY, {'sparqlFunction': lambda q: res, 'processes': 2,
+                                                    'parallelThreshold': 0, 'onStats': stats.append})
+        self.assertEqual(len(out), 10)
+        self.assertEqual(stats[0]['bindings'], 10)
+        # the start method of the application is not set
+        self.assertEqual(multiprocessing.get_start_method(allow_none=True), method)
+
+    def test_stats(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        counters = []
+        for options in ({}, {'processes': 2, 'parallelThreshold': 0}):
+            collected = []
+            sparqlTransformer(q, {'sparqlFunction': lambda q: res, 'onStats': collected.append, **options})
+            counters.append({k: collected[0][k] for k in SPARQLTransformer.STATS_COUNTERS})
+        self.assertEqual(counters[0], counters[1])
+        self.assertTrue(counters[0]['merges'] > 0)
+
+
+class SlowStream(io.BytesIO):
+    """A response body delivered in small chunks"""
+
+    def read(self, size=-1):
+        return super().read(100)
+
+
+class TestStream(unittest.TestCase):
+    def test_iter(self):
+        for filename in ['band.json', 'city.list.ld.json', 'band.liblimit.json', 'aggregates.json']:
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename), 'rb') as data:
+                stream = SlowStream(data.read())
+            out = list(SPARQLTransformer.iter_sparqlTransformer(q, {'sparqlFunction': lambda q: stream}))
+            if '@graph' in expected:
+                expected = expected['@graph']
+            self.assertEqual(dumps(out), dumps(expected))
+            self.assertTrue(stream.closed)
+
+    def test_ordered(self):
+        # the bindings of this example are grouped by band
+        q, expected, rq = load('band.liblimit.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.liblimit.json'), 'rb') as data:
+            stream = SlowStream(data.read())
+        it = SPARQLTransformer.iter_sparqlTransformer(q, {'sparqlFunction': lambda q: stream, 'ordered': True})
+        self.assertEqual(dumps(next(it)), dumps(expected[0]))
+        self.assertLess(stream.tell(), len(stream.getvalue()) / 2)
+        self.assertEqual(dumps([expected[0]] + list(it)), dumps(expected))
+
+        q['$orderby'] = 'ASC(?id)'
+        self.assertTrue(SPARQLTransformer._is_ordered_by_anchor(q, pre_process(q)[1]))
+        q['$orderby'] = ['?v1', '?id']
+        self.assertFalse(SPARQLTransformer._is_ordered_by_anchor(q, pre_process(q)[1]))
+
+    def test_dump(self):
+        for filename in ['band.json', 'city.list.ld.json', 'band.liblimit.json', 'aggregates.json']:
+            q, expected, rq = load(filename)
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+            expected = json.loads(dumps(expected))
+            entities = expected['@graph'] if '@graph' in expected else expected
+            for orjson in [True, False]:
+                with patch.dict(sys.modules, {} if orjson else {'orjson': None}):
+                    out = io.BytesIO()
+                    count = SPARQLTransformer.dump_sparqlTransformer(q, out, {'sparqlFunction': lambda q: res})
+                    self.assertEqual(json.loads(out.getvalue()), expected)
+                    self.assertEqual(count, len(entities))
+
+                    out = io.StringIO()
+                    SPARQLTransformer.dump_sparqlTransformer(q, out, {'sparqlFunction': lambda q: res}, ndjson=True)
+                    self.assertEqual([json.loads(line) for line in out.getvalue().splitlines()], entities)
+                    self.assertTrue(out.getvalue().endswith('}\n'))
+
+        out = io.StringIO()
+        q = {'proto': [{'id': '?id'}], '$where': '?id a dbo:Band'}
+        self.assertEqual(SPARQLTransformer.dump_sparqlTransformer(q, out, {'sparqlFunction': lambda q: results([])}), 0)
+        self.assertEqual(out.getvalue(), '[]')
+
+    def test_dump_numbers(self):
+        q = {'proto': [{'id': '?id', 'value': '$rdf:value'}], '$where': '?id a dbo:Band'}
+        big = str(2 ** 70)
+        res = results([{'id': uri('http://example.org/%d' % i), 'v1': dict(literal(value), datatype=XSD + datatype)}
+                       for i, (value, datatype) in enumerate([(big, 'integer'), ('NaN', 'double'), ('-INF', 'double')])])
+        outs = []
+        for orjson in [True, False]:
+            with patch.dict(sys.modules, {} if orjson else {'orjson': None}):
+                out = io.BytesIO()
+                self.assertEqual(SPARQLTransformer.dump_sparqlTransformer(q, out, {'sparqlFunction': lambda q: res}), 3)
+                outs.append(out.getvalue())
+        self.assertEqual(outs[0], outs[1])
+        self.assertEqual([e['value'] for e in json.loads(outs[0])], [2 ** 70, None, None])
+
+    def test_dump_stream(self):
+        q, expected, rq = load('band.liblimit.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.liblimit.json'), 'rb') as data:
+            stream = SlowStream(data.read())
+        size = len(stream.getvalue())
+        positions = []
+
+        class Output(io.BytesIO):
+            def write(self, data):
+                positions.append(size if stream.closed else stream.tell())
+                return super().write(data)
+
+        SPARQLTransformer.dump_sparqlTransformer(q, Output(), {'sparqlFunction': lambda q: stream, 'ordered': True})
+        # the first entity is written before the results are read
+        self.assertLess(positions[1], size / 2)
+
+
+class FakeAiohttpSession:
+    """`aiohttp.ClientSession` answering every request with the same results"""
+    results = None
+    sessions = []
+
+    def __init__(self):
+        self.closed = False
+        self.requests = []
+        self.sessions.append(self)
+
+    def get(self, url, params, headers, timeout):
+        self.requests.append(('GET', params['query']))
+        return FakeAiohttpResponse(self.results)
+
+    def post(self, url, data, headers, timeout):
+        self.requests.append(('POST', data['query']))
+        return FakeAiohttpResponse(self.results)
+
+
+class FakeAiohttpResponse:
+    def __init__(self, results):
+        self.results = results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        pass
+
+    async def json(self, content_type):
+        return self.results
+
+
+class TestAsync(unittest.TestCase):
+    def test_aiohttp(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        session = type('Session', (FakeAiohttpSession,), {'results': res, 'sessions': []})
+        aiohttp = type(sys)('aiohttp')
+        aiohttp.ClientSession = session
+        aiohttp.ClientTimeout = lambda total: total
+        long_query = dict(q, **{'$filter': 'STRLEN(?v1) < 100 || "%s" = ""' % ('x' * SPARQLTransformer.GET_MAX_LENGTH)})
+
+        async def run():
+            options = {'endpoint': 'http://example.org/sparql'}
+            outs = [await SPARQLTransformer.sparqlTransformer_async(query, options) for query in [q, q, long_query]]
+            options = {'endpoint': 'http://example.org/other'}
+            outs.append(await SPARQLTransformer.sparqlTransformer_async(q, options))
+            return outs
+
+        with patch.dict(sys.modules, {'aiohttp': aiohttp}):
+            outs = asyncio.run(run())
+        self.assertTrue(all(dumps(out) == dumps(expected) for out in outs))
+        # a session by endpoint, reused by the queries
+        self.assertEqual([[method for method, query in s.requests] for s in session.sessions],
+                         [['GET', 'GET', 'POST'], ['GET']])
+        self.assertEqual(session.sessions[0].requests[0][1], get_sparql_query(q))
+
+    def test_async_function(self):
+        q, expected, rq = load('city.region.list.ld.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'city.region.list.ld.json')) as data:
+            res = json.load(data)
+
+        async def sparql_function(query):
+            await asyncio.sleep(0)
+            return res
+
+        out = asyncio.run(SPARQLTransformer.sparqlTransformer_async(q, {'sparqlFunction': sparql_function}))
+        self.assertEqual(dumps(out), dumps(expected))
+
+        with ThreadPoolExecutor(1) as executor:
+            out = asyncio.run(SPARQLTransformer.sparqlTransformer_async(q, {'sparqlFunction': lambda q: res,
+                                                                             'executor': executor}))
+        self.assertEqual(dumps(out), dumps(expected))
+
+
+class TestBatch(unittest.TestCase):
+    def test_batch(self):
+        filenames = ['band.json', 'city.list.json', 'aggregates.json', 'band_forcelist.json']
+
+        def slow_function(filename):
+            with open(os.path.join(SPARQL_OUTPUT, filename)) as data:
+                res = json.load(data)
+
+            def f(q):
+                time.sleep(0.2)
+                return res
+
+            return f
+
+        def failing_function(q):
+            raise IOError('endpoint down')
+
+        queries = [(load(f)[0], {'sparqlFunction': slow_function(f)}) for f in filenames]
+        queries.insert(1, (load('band.json')[0], {'sparqlFunction': failing_function}))
+        queries.append({'wrong': 'query'})
+
+        start = time.time()
+        out = SPARQLTransformer.sparqlTransformer_batch(queries, concurrency=4)
+        self.assertLess(time.time() - start, 0.6)
+
+        self.assertEqual(len(out), 6)
+        self.assertIsInstance(out[1], IOError)
+        self.assertIsInstance(out[5], KeyError)
+        out = out[:1] + out[2:5]
+        self.assertEqual(dumps(out), dumps([load(f)[1] for f in filenames]))
+
+
+VALUES_QUERY = {'proto': {'id': '?id$anchor', 'name': '$rdfs:label'},
+                '$values': {'id': ['http://example.org/%d' % i for i in range(25)]}}
+
+
+def values_endpoint(queries, delay=0):
+    """A SPARQL function answering with a label for each IRI in the VALUES of the query"""
+    def f(q):
+        queries.append(q)
+        time.sleep(delay)
+        ids = re.search(r'VALUES \?id \{(.*?)\}', q).group(1).split()
+        return results([{'id': uri(i[1:-1]), 'v1': literal('name %s' % i[-2])} for i in ids])
+
+    return f
+
+
+class TestValuesChunks(unittest.TestCase):
+    def test_stats(self):
+        collected = []
+        start = time.perf_counter()
+        sparqlTransformer(VALUES_QUERY, {'sparqlFunction': values_endpoint([], delay=0.2), 'valuesChunkSize': 5,
+                                         'onStats': collected.append})
+        elapsed = time.perf_counter() - start
+        stats, = collected
+        # the 5 chunks run at the same time: the network stage is their wall time, not the sum of their times
+        self.assertGreaterEqual(stats['network'], 0.2)
+        self.assertLess(stats['network'], elapsed)
+
+    def test_chunks(self):
+        queries = []
+        expected = sparqlTransformer(VALUES_QUERY, {'sparqlFunction': values_endpoint(queries)})
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(len(expected), 25)
+
+        queries.clear()
+        start = time.time()
+        out = sparqlTransformer(VALUES_QUERY, {'sparqlFunction': values_endpoint(queries, 0.2),
+                                               'valuesChunkSize': 10})
+        self.assertLess(time.time() - start, 0.4)
+        self.assertEqual(out, expected)
+        self.assertEqual([q.count('<http://example.org/') for q in queries], [10, 10, 5])
+
+        def tsv_endpoint(q):
+            return to_tsv(dict(values_endpoint([])(q), head={'vars': ['id', 'v1']}))
+
+        out = sparqlTransformer(VALUES_QUERY, {'sparqlFunction': tsv_endpoint, 'valuesChunkSize': 10})
+        self.assertEqual(out, expected)
+
+        async def async_endpoint(q):
+            return values_endpoint([])(q)
+
+        out = asyncio.run(SPARQLTransformer.sparqlTransformer_async(VALUES_QUERY, {'sparqlFunction': async_endpoint,
+                                                                                   'valuesChunkSize': 10}))
+        self.assertEqual(out, expected)
+
+        out = SPARQLTransformer.sparqlTransformer_batch([(VALUES_QUERY, {'sparqlFunction': values_endpoint([]),
+                                                                         'valuesChunkSize': 7})])
+        self.assertEqual(out, [expected])
+
+    def test_query(self):
+        query, _, opt = pre_process(VALUES_QUERY, {'valuesChunkSize': 10})
+        self.assertEqual(query, get_sparql_query(VALUES_QUERY))
+        self.assertEqual(len(opt['queries']), 3)
+
+        for extra in ({'$orderby': '?id'}, {'$limit': 10}, {'$limit': 10, '$limitMode': 'library', '$offset': 2}):
+            queries = []
+            q = dict(VALUES_QUERY, **extra)
+            out = sparqlTransformer(q, {'sparqlFunction': values_endpoint(queries), 'valuesChunkSize': 10})
+            self.assertEqual(out, sparqlTransformer(q, {'sparqlFunction': values_endpoint([])}))
+            self.assertEqual(len(queries), 3 if '$limitMode' in extra else 1)
+
+
+def band_graph(bands=5):
+    """An rdflib graph of bands, with typed and language-tagged literals"""
+    ex, xsd = rdflib.Namespace('http://example.org/'), rdflib.XSD
+    g = rdflib.Graph()
+    for i in range(bands):
+        band = ex['band/%d' % i]
+        g.add((band, rdflib.RDF.type, ex.Band))
+        g.add((band, rdflib.RDFS.label, rdflib.Literal('Band %d' % i, lang='en')))
+        g.add((band, rdflib.RDFS.label, rdflib.Literal('Gruppo %d' % i, lang='it')))
+        g.add((band, ex.members, rdflib.Literal(i + 2)))
+        g.add((band, ex.rating, rdflib.Literal(i / 2, datatype=xsd.double)))
+        g.add((band, ex.active, rdflib.Literal(i % 2 == 0)))
+        g.add((band, ex.founded, rdflib.Literal('199%d-01-01' % i, datatype=xsd.date)))
+        g.add((band, ex.place, rdflib.BNode('place%d' % i)))
+        for j in range(2):
+            g.add((band, ex.member, ex['member/%d/%d' % (i, j)]))
+            g.add((ex['member/%d/%d' % (i, j)], rdflib.RDFS.label, rdflib.Literal('Member %d' % j)))
+    return g
+
+
+BAND_GRAPH_QUERY = {
+    'proto': {'id': '?id', 'name': '$rdfs:label', 'members': '$ex:members', 'rating': '$ex:rating',
+              'active': '$ex:active', 'founded': '$ex:founded', 'place': '$ex:place', 'ids': ['?id'],
+              'member': {'id': '$ex:member', 'name': '$rdfs:label$lang:en'}},
+    '$where': '?id a ex:Band',
+    '$prefixes': {'ex': 'http://example.org/'}
+}
+
+
+@unittest.skipIf(rdflib is None, 'rdflib is not installed')
+class TestGraph(unittest.TestCase):
+    def test_graph(self):
+        g = band_graph()
+
+        def json_function(q):
+            return json.loads(g.query(q).serialize(format='json'))
+
+        for q in [BAND_GRAPH_QUERY, dict(BAND_GRAPH_QUERY, **{'$lang': 'it'}),
+                  {'@context': 'http://schema.org/', '@graph': [{'@id': '?id', 'name': '$rdfs:label$required'}],
+                   '$prefixes': {'ex': 'http://example.org/'}, '$where': '?id a ex:Band'}]:
+            expected = sparqlTransformer(q, {'sparqlFunction': json_function})
+            self.assertEqual(sparqlTransformer(q, {'graph': g}), expected)
+            self.assertEqual(sparqlTransformer(q, {'sparqlFunction': g.query}), expected)
+
+        out = sparqlTransformer(BAND_GRAPH_QUERY, {'graph': g})
+        self.assertEqual(len(out), 5)
+        self.assertEqual(out[1]['members'], 3)
+        self.assertIs(out[1]['active'], False)
+        self.assertEqual(out[1]['rating'], 0.5)
+        self.assertEqual(out[1]['name'], [{'language': 'en', 'value': 'Band 1'}, {'language': 'it', 'value': 'Gruppo 1'}])
+        self.assertEqual(out[1]['place'], 'place1')
+        self.assertIs(type(out[1]['id']), str)
+
+    def test_options(self):
+        g = band_graph()
+        expected = sparqlTransformer(BAND_GRAPH_QUERY, {'graph': g})
+        self.assertEqual(list(SPARQLTransformer.iter_sparqlTransformer(BAND_GRAPH_QUERY, {'graph': g})), expected)
+        self.assertEqual(asyncio.run(SPARQLTransformer.sparqlTransformer_async(BAND_GRAPH_QUERY, {'graph': g})),
+                         expected)
+
+        q = dict(BAND_GRAPH_QUERY, **{'$values': {'id': ['http://example.org/band/%d' % i for i in range(5)]}})
+        self.assertEqual(sparqlTransformer(q, {'graph': g, 'valuesChunkSize': 2}), expected)
+
+        stats = []
+        sparqlTransformer(BAND_GRAPH_QUERY, {'graph': g, 'onStats': stats.append,
+                                             'resultCache': SPARQLTransformer.ResultCache()})
+        self.assertEqual(stats[0]['bindings'], 20)
+        self.assertEqual(stats[0]['entities'], 5)
+
+
+WIDE_QUERY = {
+    'proto': {
+        'id': '?id$anchor',
+        'name': '$rdfs:label$required',
+        'rating': '$ex:rating',
+        'member': {'id': '$ex:member$anchor', 'name': '$rdfs:label'},
+        'albums': {'id': '$ex:member$anchor', 'label': '$rdfs:label$lang:it'},
+        'tags': '$ex:founded$list'
+    },
+    '$where': '?id a ex:Band',
+    '$prefixes': {'ex': 'http://example.org/'}
+}
+
+# the variable of the nested members is used in `$where`: the query cannot be split
+MEMBER_WHERE_QUERY = dict(WIDE_QUERY, proto=dict(WIDE_QUERY['proto'], member={'id': '$ex:member$anchor$var:?m',
+                                                                              'name': '?ml'}),
+                          **{'$where': ['?id a ex:Band', '?m rdfs:label ?ml']})
+
+
+class TestSplit(unittest.TestCase):
+    def test_queries(self):
+        query, proto, opt = pre_process(WIDE_QUERY, {'splitQuery': True})
+        self.assertEqual(query, get_sparql_query(WIDE_QUERY))
+        self.assertEqual(opt['split_keys'], ['member', 'albums', 'tags'])
+        queries = opt['queries']
+        self.assertEqual(len(queries), 4)
+        self.assertIn('SELECT DISTINCT ?id ?v1 ?v2\n', queries[0])
+        self.assertNotIn('OPTIONAL { ?id ex:member', queries[0])
+        self.assertIn('SELECT DISTINCT ?id ?v3r ?v31\n', queries[1])
+        self.assertIn('?id rdfs:label ?v1', queries[1])
+        self.assertIn('SELECT DISTINCT ?id ?v5\n', queries[3])
+
+        query, proto, opt = pre_process(WIDE_QUERY, {'splitQuery': ['tags']})
+        self.assertEqual(len(opt['queries']), 2)
+
+        for extra in [{'$orderby': '?v1'}, {'$limit': 10}, {'$filter': 'lang(?v31) = "en"'}]:
+            query, proto, opt = pre_process(dict(WIDE_QUERY, **extra), {'splitQuery': True})
+            self.assertNotIn('queries', opt)
+        query, proto, opt = pre_process(dict(WIDE_QUERY, **{'$filter': 'lang(?v1) = "en"'}), {'splitQuery': True})
+        self.assertEqual(len(opt['queries']), 4)
+        query, proto, opt = pre_process(MEMBER_WHERE_QUERY, {'splitQuery': True})
+        self.assertNotIn('queries', opt)
+
+    @unittest.skipIf(rdflib is None, 'rdflib is not installed')
+    def test_split(self):
+        g = band_graph()
+
+        def json_function(rows):
+            def f(q):
+                res = json.loads(g.query(q).serialize(format='json'))
+                rows.append(len(res['results']['bindings']))
+                return res
+            return f
+
+        # nested objects with the values of the first query are not added to the entities without them
+        band_albums = dict(WIDE_QUERY, proto=dict(WIDE_QUERY['proto'], albums={'id': '$ex:member$anchor', 'band': '?id'}))
+        for q in [WIDE_QUERY, BAND_GRAPH_QUERY, band_albums, MEMBER_WHERE_QUERY, dict(WIDE_QUERY, **{'$limit': 2, '$limitMode': 'library'}),
+                  dict(WIDE_QUERY, **{'$values': {'id': ['http://example.org/band/%d' % i for i in range(4)]}})]:
+            single, split = [], []
+            expected = sparqlTransformer(q, {'sparqlFunction': json_function(single)})
+            out = sparqlTransformer(q, {'sparqlFunction': json_function(split), 'splitQuery': True})
+            self.assertEqual(dumps(out), dumps(expected))
+            self.assertLessEqual(sum(split), sum(single))
+            if q is WIDE_QUERY:
+                self.assertEqual((sum(single), sum(split)), (40, 35))
+
+            tsv = sparqlTransformer(q, {'sparqlFunction': lambda q: to_tsv(json_function([])(q)), 'splitQuery': True})
+            self.assertEqual(dumps(tsv), dumps(expected))
+
+
+    @unittest.skipIf(rdflib is None, 'rdflib is not installed')
+    def test_not_split_objects(self):
+        g = band_graph()
+        q = {'proto': {'id': '?id', 'member': {'id': '$ex:member', 'name': '$rdfs:label'}, 'names': '$rdfs:label$list'},
+             '$where': '?id a ex:Band', '$prefixes': {'ex': 'http://example.org/'}}
+        required = dict(q, proto=dict(q['proto'], member={'id': '$ex:member$required', 'name': '$rdfs:label'}))
+        for query, split in [(q, ['names']), (q, True), (required, True), (required, ['names'])]:
+            expected = sparqlTransformer(query, {'sparqlFunction': g.query})
+            self.assertTrue(all(len(band['member']) == 2 for band in expected))
+            out = sparqlTransformer(query, {'sparqlFunction': g.query, 'splitQuery': split})
+            self.assertEqual(dumps(out), dumps(expected))
+            # the queries on a local graph are not split
+            self.assertNotIn('split_keys', pre_process(query, {'graph': g, 'splitQuery': split})[2])
+            out = sparqlTransformer(query, {'graph': g, 'splitQuery': split})
+            self.assertEqual(dumps(out), dumps(expected))
+
+
+class StubEndpoint(BaseHTTPRequestHandler):
+    """SPARQL endpoint answering every query with the same results"""
+    protocol_version = 'HTTP/1.1'
+    results = b'{}'
+    delay = 0
+    status = 200
+    connections = 0
+    requests = []
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def do_GET(self):
+        self.answer(parse_qs(urlsplit(self.path).query)['query'][0])
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.answer(parse_qs(body)['query'][0])
+
+    def answer(self, query):
+        type(self).requests.append((self.command, query, self.headers.get('Accept-Encoding', '')))
+        time.sleep(self.delay)
+        body = self.results
+        self.send_response(self.status)
+        self.send_header('Content-Type', 'application/sparql-results+json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_endpoint(filename, delay=0):
+    """Start a stub endpoint in a thread, return the server and its URL"""
+    with open(os.path.join(SPARQL_OUTPUT, filename), 'rb') as data:
+        handler = type('Handler', (StubEndpoint,), {'results': data.read(), 'delay': delay, 'requests': []})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/sparql' % server.server_address[1]
+
+
+class TestEndpointClient(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_endpoint('band.json')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_connection_reuse(self):
+        q, expected, rq = load('band.json')
+        for _ in range(3):
+            out = sparqlTransformer(q, {'endpoint': self.endpoint})
+            self.assertEqual(dumps(out), dumps(expected))
+        out = list(SPARQLTransformer.iter_sparqlTransformer(q, {'endpoint': self.endpoint}))
+        self.assertEqual(dumps(out), dumps(expected))
+        out = sparqlTransformer(q, {'endpoint': self.endpoint})
+        self.assertEqual(dumps(out), dumps(expected))
+
+        handler = self.server.RequestHandlerClass
+        self.assertEqual(handler.connections, 1)
+        self.assertEqual(len(handler.requests), 5)
+        self.assertTrue(all(r[0] == 'GET' and 'gzip' in r[2] for r in handler.requests))
+
+    def test_stats(self):
+        q, expected, rq = load('band.json')
+        collected = []
+        out = sparqlTransformer(q, {'endpoint': self.endpoint, 'onStats': collected.append})
+        self.assertEqual(dumps(out), dumps(expected))
+        stats, = collected
+        self.assertTrue(stats['network'] > 0 and stats['decode'] > 0)
+
+    def test_long_query(self):
+        query = 'SELECT * WHERE { ?s ?p ?o } # ' + 'x' * SPARQLTransformer.GET_MAX_LENGTH
+        SPARQLTransformer._default_sparql(self.endpoint)(query)
+        method, received, _ = self.server.RequestHandlerClass.requests[-1]
+        self.assertEqual((method, received), ('POST', query))
+
+
+class TestEndpointPool(unittest.TestCase):
+    def setUp(self):
+        self.servers, self.endpoints = zip(*[start_endpoint('band.json') for _ in range(2)])
+        self.query, self.expected, _ = load('band.json')
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def requests(self):
+        return [len(server.RequestHandlerClass.requests) for server in self.servers]
+
+    def run_query(self, options):
+        out = sparqlTransformer(self.query, dict({'endpoint': list(self.endpoints)}, **options))
+        self.assertEqual(dumps(out), dumps(self.expected))
+
+    def test_round_robin(self):
+        for _ in range(4):
+            self.run_query({})
+        self.assertEqual(self.requests(), [2, 2])
+
+        out = list(SPARQLTransformer.iter_sparqlTransformer(self.query, {'endpoint': list(self.endpoints)}))
+        self.assertEqual(dumps(out), dumps(self.expected))
+        self.assertEqual(sum(self.requests()), 5)
+
+    def test_failover(self):
+        self.servers[0].RequestHandlerClass.status = 503
+        for _ in range(4):
+            self.run_query({'endpointCooldown': 60})
+        # the failing endpoint is skipped after the first failure
+        self.assertEqual(self.requests(), [1, 4])
+
+        self.servers[1].RequestHandlerClass.status = 400
+        with self.assertRaises(HTTPError):
+            sparqlTransformer(self.query, {'endpoint': list(self.endpoints), 'endpointCooldown': 60})
+        self.assertEqual(self.requests(), [1, 5])
+
+    def test_least_outstanding(self):
+        self.servers[0].RequestHandlerClass.delay = 0.5
+        options = {'endpoint': list(self.endpoints), 'endpointPolicy': 'least-outstanding'}
+        outs = SPARQLTransformer.sparqlTransformer_batch([(self.query, options)] * 8, concurrency=2)
+        self.assertTrue(all(dumps(out) == dumps(self.expected) for out in outs))
+        slow, fast = self.requests()
+        self.assertLess(slow, fast)
+
+        with self.assertRaises(ValueError):
+            sparqlTransformer(self.query, dict(options, endpointPolicy='random'))
+
+    def test_hedging(self):
+        options = {'hedgePercentile': 90}
+        for _ in range(SPARQLTransformer.HEDGE_MIN_SAMPLES):
+            self.run_query(options)
+        self.servers[0].RequestHandlerClass.delay = 2
+        before = self.requests()
+        for _ in range(2):
+            start = time.perf_counter()
+            self.run_query(options)
+            self.assertLess(time.perf_counter() - start, 1)
+        # the queries sent in turn to the slow endpoint are answered by the fast one
+        self.assertEqual([n - b for n, b in zip(self.requests(), before)], [2, 2])
+
+
+class TestCommandLine(unittest.TestCase):
+    def setUp(self):
+        self.server, self.endpoint = start_endpoint('band.json')
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_output(self):
+        q, expected, _ = load('band.json')
+        os.makedirs(os.path.join(self.tmp.name, 'queries', 'nested'))
+        for name in ['band.json', os.path.join('nested', 'band.json')]:
+            with open(os.path.join(self.tmp.name, 'queries', name), 'w') as f:
+                json.dump(q, f)
+        output = os.path.join(self.tmp.name, 'output')
+        status = SPARQLTransformer.main([os.path.join(self.tmp.name, 'queries'), '-o', output, '-e', self.endpoint,
+                                         '--workers', '2'])
+        self.assertEqual(status, 0)
+        for name in ['band.json', os.path.join('nested', 'band.json')]:
+            with open(os.path.join(output, name)) as f:
+                self.assertEqual(dumps(json.load(f)), dumps(expected))
+        self.assertEqual(len(self.server.RequestHandlerClass.requests), 2)
+
+    def test_ndjson(self):
+        q, expected, _ = load('band.json')
+        ndjson = os.path.join(self.tmp.name, 'out.ndjson')
+        missing = os.path.join(self.tmp.name, 'missing.json')
+        status = SPARQLTransformer.main([JSONLD_QUERIES + 'band.json', missing, '--ndjson', ndjson,
+                                         '-e', self.endpoint])
+        self.assertEqual(status, 1)
+        with open(ndjson) as f:
+            records = {r['query']: r for r in map(json.loads, f)}
+        self.assertEqual(dumps(records[JSONLD_QUERIES + 'band.json']['output']), dumps(expected))
+        self.assertIn('error', records[missing])
+
+    def test_dry_run(self):
+        out = subprocess.run([sys.executable, '-m', 'SPARQLTransformer', '--dry-run', JSONLD_QUERIES + 'band*.json'],
+                             capture_output=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        records = [json.loads(line) for line in out.stdout.splitlines()]
+        self.assertEqual(len(records), len([f for f in os.listdir(JSONLD_QUERIES) if f.startswith('band')]))
+        for record in records:
+            with open(record['query']) as f:
+                self.assertEqual(record['sparql'], get_sparql_query(json.load(f)))
+        self.assertIn(b'%d queries (0 failed)' % len(records), out.stderr)
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def sparql_function(self, q):
+        self.calls.append(q)
+        time.sleep(0.1)
+        return results([{'id': uri(q)}])
+
+    def test_ttl_and_eviction(self):
+        cache = SPARQLTransformer.ResultCache(maxsize=2, ttl=0.3)
+        for q in ['a', 'b', 'a', 'c', 'a', 'b']:
+            cache.fetch('endpoint', q, self.sparql_function)
+        self.assertEqual(self.calls, ['a', 'b', 'c', 'b'])
+        time.sleep(0.3)
+        cache.fetch('endpoint', 'a', self.sparql_function)
+        self.assertEqual(self.calls[-1], 'a')
+
+    def test_persistent(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite')
+            cache = SPARQLTransformer.ResultCache(path=path)
+            sparqlTransformer(q, {'sparqlFunction': lambda q: res, 'resultCache': cache})
+
+            cache = SPARQLTransformer.ResultCache(path=path)
+            out = sparqlTransformer(q, {'sparqlFunction': self.sparql_function, 'resultCache': cache})
+            self.assertEqual(dumps(out), dumps(expected))
+            self.assertEqual(self.calls, [])
+
+    def test_coalescing(self):
+        cache = SPARQLTransformer.ResultCache()
+        with ThreadPoolExecutor(8) as executor:
+            out = list(executor.map(lambda i: cache.fetch('endpoint', 'q', self.sparql_function), range(8)))
+        self.assertEqual(self.calls, ['q'])
+        self.assertTrue(all(o is out[0] for o in out))
+
+    def test_coalescing_async(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            res = json.load(data)
+
+        async def sparql_function(query):
+            self.calls.append(query)
+            await asyncio.sleep(0.1)
+            return res
+
+        async def run():
+            options = {'sparqlFunction': sparql_function, 'resultCache': SPARQLTransformer.ResultCache()}
+            return await asyncio.gather(*[SPARQLTransformer.sparqlTransformer_async(q, options) for _ in range(5)])
+
+        outs = asyncio.run(run())
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(all(dumps(out) == dumps(expected) for out in outs))
+
+    def test_persistent_formats(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json')) as data:
+            tsv = to_tsv(json.load(data)).encode('utf-8')
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.sqlite')
+            cache = SPARQLTransformer.ResultCache(path=path)
+            out = sparqlTransformer(q, {'sparqlFunction': lambda q: tsv, 'resultCache': cache})
+            self.assertEqual(dumps(out), dumps(expected))
+            out = sparqlTransformer(q, {'sparqlFunction': self.sparql_function,
+                                        'resultCache': SPARQLTransformer.ResultCache(path=path)})
+            self.assertEqual(dumps(out), dumps(expected))
+            self.assertEqual(self.calls, [])
+
+            if rdflib is not None:  # kept in memory only
+                cache = SPARQLTransformer.ResultCache(path=path)
+                g = band_graph()
+                expected = sparqlTransformer(BAND_GRAPH_QUERY, {'graph': g})
+                for _ in range(2):
+                    out = sparqlTransformer(BAND_GRAPH_QUERY, {'sparqlFunction': g.query, 'resultCache': cache})
+                    self.assertEqual(dumps(out), dumps(expected))
+                self.assertEqual(cache.hits, 1)
+
+    def test_stream(self):
+        q, expected, rq = load('band.json')
+        with open(os.path.join(SPARQL_OUTPUT, 'band.json'), 'rb') as data:
+            body = data.read()
+        if '@graph' in expected:
+            expected = expected['@graph']
+        options = {'sparqlFunction': lambda q: io.BytesIO(body), 'resultCache': SPARQLTransformer.ResultCache()}
+        for _ in range(2):
+            out = list(SPARQLTransformer.iter_sparqlTransformer(q, options))
+            self.assertEqual(dumps(out), dumps(expected))
+        self.assertEqual(options['resultCache'].hits, 1)
+
+
 if __name__ == '__main__':
     unittest.main()